@@ -7,12 +7,25 @@ the raw HPG ventilation images and dataset = 1 is the binary mask array. So the
 code as it's written here simply open that Nifti file, calculates N4 corrected
 HPG images and appends those to the original Niftis dataset dimension.
 1/20/2024, RP Thomen
+
+Batch version: cases are processed in parallel (a process pool, each worker with its own number of
+SimpleITK threads), cases whose output is already newer than their input and was made with the same settings
+(saved in the output's Nifti header description) are skipped (so you can stop and restart a long run), and each
+case's time is reported. With a shrink factor the bias field is fit
+on in-plane downsampled images and then applied at full resolution, which is much faster and gives
+nearly the same correction (the bias field is smooth anyway). Outputs are float32 unless --float64.
+Examples:
+    python "Add N4correction to Niftis.py" --input Niftis --output N4Niftis --workers 4 --threads 2 --shrink 4
+    python "Add N4correction to Niftis.py" --benchmark
 '''
 import nibabel as nib
 import numpy as np
 import SimpleITK as sitk # ---------------- for N4 Bias Correection
 import time
 import os
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def load_Nifti_file(path):
     activeNifti  = nib.load(path)
@@ -21,13 +34,14 @@ def load_Nifti_file(path):
     nii_hdr  = activeNifti.header
     return(nii_data,nii_aff,nii_hdr)
 
-def N4_bias_correction(HPvent, mask):
-    start_time = time.time()
-    print('Performing Bias Correction...')
-
+def N4_bias_correction(HPvent, mask, shrinkFactor=1, maxIterations=None):
+    '''N4 bias correction of a 3D HPG image within the mask. With shrinkFactor > 1 the bias field is fit on
+        images downsampled in-plane by that factor (slices are left alone, there usually aren't many) and
+        then evaluated and divided out at full resolution. maxIterations is a list, one per fitting level.
+        The number of SimpleITK threads is the global default (see setWorkerThreads)'''
     # Convert NumPy arrays to SimpleITK images
     image = sitk.GetImageFromArray(HPvent.astype(np.float32))
-    mask = sitk.GetImageFromArray(mask.astype(np.float32))
+    mask = sitk.GetImageFromArray((mask>0).astype(np.uint8))
 
     #Cast to correct format for SimpleITK
     image = sitk.Cast(image, sitk.sitkFloat32)
@@ -35,22 +49,122 @@ def N4_bias_correction(HPvent, mask):
 
     #Run Bias Correction
     corrector = sitk.N4BiasFieldCorrectionImageFilter()
-    corrected_image = corrector.Execute(image, mask)
+    if maxIterations is not None:
+        corrector.SetMaximumNumberOfIterations(maxIterations)
+    if shrinkFactor > 1:
+        # -- numpy [rows, cols, slices] is SimpleITK (x=slices, y=cols, z=rows), so don't shrink x
+        shrink = [1, shrinkFactor, shrinkFactor]
+        corrector.Execute(sitk.Shrink(image,shrink), sitk.Shrink(mask,shrink))
+        logBiasField = corrector.GetLogBiasFieldAsImage(image)
+        corrected_image = image / sitk.Exp(logBiasField)
+    else:
+        corrected_image = corrector.Execute(image, mask)
     corrected_HPvent = sitk.GetArrayFromImage(corrected_image)
-    print(f'Bias Correction Completed in {np.round(time.time()-start_time,2)} seconds')
     return corrected_HPvent
 
+def settingsDescription(shrinkFactor=1, maxIterations=None, dtype=np.float32):
+    '''The correction settings as saved in each output's header ('descrip', max 80 characters)'''
+    iterations = 'default' if maxIterations is None else ','.join(str(n) for n in maxIterations)
+    return f'N4 shrink={shrinkFactor} iterations={iterations} {np.dtype(dtype).name}'[:80]
 
-if __name__ == "__main__":
-    nifti_dir = 'C:/PIRL/GUI/Niftis/'
-    output_dir = 'C:/PIRL/GUI/N4Niftis/'
-    fileList = os.listdir(nifti_dir)
-    for k in range(len(fileList)):
-        print(f'Opening case {k}/{len(fileList)}: {fileList[k]}')
-        nii_data, _, _ = load_Nifti_file(f"{nifti_dir}{fileList[k]}")
-        nifti_array = np.zeros((nii_data.shape[0],nii_data.shape[1],nii_data.shape[2],3))
-        nifti_array[:,:,:,:2] = nii_data[:,:,:,:2]
-        nifti_array[:,:,:,2] = N4_bias_correction(nii_data[:,:,:,0],nii_data[:,:,:,1])
-        niImage = nib.Nifti1Image(nifti_array, affine=np.eye(4))
-        nib.save(niImage,os.path.join(output_dir,fileList[k]))
+def isUpToDate(inputPath, outputPath, settings=None):
+    '''True if the output exists, was written after the input was last changed and (if settings is given, see
+        settingsDescription) was made with the same settings'''
+    if not os.path.exists(outputPath) or os.path.getmtime(outputPath) < os.path.getmtime(inputPath):
+        return False
+    if settings is None:
+        return True
+    try:
+        descrip = nib.load(outputPath).header['descrip'].item()
+    except Exception:
+        return False
+    return (descrip.decode('ascii','replace') if isinstance(descrip,bytes) else str(descrip)) == settings
+
+def correctCase(inputPath, outputPath, shrinkFactor=1, maxIterations=None, dtype=np.float32):
+    '''Reads one [rows, cols, slices, 2+] Nifti, adds the N4 corrected images as dataset 2 and saves it.
+        The output is written under a temporary name and renamed when done, so a half written file is never
+        mistaken for an up to date one. Returns the time taken in seconds'''
+    start_time = time.time()
+    nii_data, nii_aff, _ = load_Nifti_file(inputPath)
+    nifti_array = np.zeros((nii_data.shape[0],nii_data.shape[1],nii_data.shape[2],3),dtype=dtype)
+    nifti_array[:,:,:,:2] = nii_data[:,:,:,:2]
+    nifti_array[:,:,:,2] = N4_bias_correction(nii_data[:,:,:,0],nii_data[:,:,:,1],shrinkFactor,maxIterations)
+    niImage = nib.Nifti1Image(nifti_array, affine=nii_aff)
+    niImage.header['descrip'] = settingsDescription(shrinkFactor,maxIterations,dtype)
+    tempPath = os.path.join(os.path.dirname(outputPath),'.tmp-'+os.path.basename(outputPath))
+    nib.save(niImage,tempPath)
+    os.replace(tempPath,outputPath)
+    return time.time()-start_time
 
+def setWorkerThreads(nThreads):
+    '''Process pool initializer: limits each worker's SimpleITK threads so workers x threads fits the machine'''
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(nThreads)
+
+def correctFolder(nifti_dir, output_dir, workers=1, threads=None, shrinkFactor=1, maxIterations=None, dtype=np.float32, force=False):
+    '''N4 corrects every Nifti in nifti_dir into output_dir using a pool of 'workers' processes with 'threads'
+        SimpleITK threads each. Up to date outputs (made from the current input with the same shrinkFactor, maxIterations
+        and dtype) are skipped unless force. Returns {fileName: seconds}'''
+    os.makedirs(output_dir,exist_ok=True)
+    if threads is None:
+        threads = max(1,(os.cpu_count() or 1)//workers)
+    fileList = sorted(f for f in os.listdir(nifti_dir) if not f.startswith('.tmp-'))
+    settings = settingsDescription(shrinkFactor,maxIterations,dtype)
+    todo = [f for f in fileList if force or not isUpToDate(os.path.join(nifti_dir,f),os.path.join(output_dir,f),settings)]
+    print(f'{len(fileList)-len(todo)} of {len(fileList)} cases are already up to date. Correcting {len(todo)} cases with {workers} workers x {threads} threads, shrink factor {shrinkFactor}')
+    timings = {}
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers,initializer=setWorkerThreads,initargs=(threads,)) as pool:
+        futures = {pool.submit(correctCase,os.path.join(nifti_dir,f),os.path.join(output_dir,f),shrinkFactor,maxIterations,dtype): f for f in todo}
+        for k, future in enumerate(as_completed(futures)):
+            fileName = futures[future]
+            try:
+                timings[fileName] = future.result()
+                print(f'Case {k+1}/{len(todo)}: {fileName} corrected in {np.round(timings[fileName],2)} seconds')
+            except Exception as e:
+                # -- one bad case shouldn't stop the whole cohort, it will just be tried again next run
+                print(f'\033[31mCase {k+1}/{len(todo)}: {fileName} failed: {e}\033[37m')
+    total_time = time.time()-start_time
+    if timings:
+        print(f'Corrected {len(timings)} cases in {np.round(total_time,1)} seconds ({np.round(60*len(timings)/total_time,1)} cases/minute)')
+    return timings
+
+def benchmark(nCases=8, shape=(128,128,20), configs=None):
+    '''Throughput of correctFolder on synthetic phantoms for a few worker/thread/shrink settings'''
+    import syntheticPhantoms
+    if configs is None:
+        nCPU = os.cpu_count() or 1
+        configs = [(1,nCPU,1), (1,nCPU,4), (max(1,nCPU//2),2,4), (nCPU,1,4)]
+    with tempfile.TemporaryDirectory() as folder:
+        nifti_dir = os.path.join(folder,'Niftis')
+        syntheticPhantoms.writePhantomFolder(nifti_dir,nCases,includeN4=False,rows=shape[0],cols=shape[1],slices=shape[2])
+        results = []
+        for workers, threads, shrinkFactor in configs:
+            output_dir = os.path.join(folder,f'N4_{workers}_{threads}_{shrinkFactor}')
+            start_time = time.time()
+            correctFolder(nifti_dir,output_dir,workers,threads,shrinkFactor)
+            total_time = time.time()-start_time
+            results.append((workers,threads,shrinkFactor,total_time))
+    print('\nworkers  threads  shrink  seconds  cases/minute')
+    for workers, threads, shrinkFactor, total_time in results:
+        print(f'{workers:7d}  {threads:7d}  {shrinkFactor:6d}  {total_time:7.1f}  {60*nCases/total_time:12.1f}')
+    return results
+
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description='Batch N4 bias correction of 4D HPG Niftis [rows, cols, slices, (vent, mask)]')
+    parser.add_argument('--input',default=os.path.join(script_dir,'Niftis'),help='folder of Niftis with vent and mask')
+    parser.add_argument('--output',default=os.path.join(script_dir,'N4Niftis'),help='folder for Niftis with vent, mask and N4 vent')
+    parser.add_argument('--workers',type=int,default=1,help='number of cases corrected at once')
+    parser.add_argument('--threads',type=int,default=None,help='SimpleITK threads per worker (default: cores/workers)')
+    parser.add_argument('--shrink',type=int,default=1,help='in-plane shrink factor for fitting the bias field')
+    parser.add_argument('--iterations',type=int,nargs='+',default=None,help='max iterations for each fitting level (default 50 50 50 50)')
+    parser.add_argument('--float64',action='store_true',help='save float64 outputs like older versions')
+    parser.add_argument('--force',action='store_true',help='redo cases even if their output is up to date')
+    parser.add_argument('--benchmark',action='store_true',help='time the pipeline on synthetic phantoms instead')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+    else:
+        correctFolder(args.input,args.output,args.workers,args.threads,args.shrink,args.iterations,
+                      np.float64 if args.float64 else np.float32,args.force)
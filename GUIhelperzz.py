@@ -1,11 +1,35 @@
 import sys
 import os
-from random import shuffle
+import hashlib
+from random import shuffle, Random
+import time
+import threading
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from PIL import Image, ImageTk
-import nibabel as nib
-from scipy.signal import medfilt2d
-import openpyxl
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+## -- scipy, nibabel, openpyxl, ImageTk (tkinter) and multiprocessing are slow to import, so they're imported in the functions that use
+## -- them - the GUI window can then open before they're loaded (PyInstaller still finds them)
+
+## -- Overlay colors for the defect display (RGB)
+defectColor = np.array([255,0,0],dtype=np.uint8)
+borderColor = np.array([0,128,255],dtype=np.uint8)
+
+## -- Column headers of the results xlsx, in order
+resultColumns = ['File Name','N4 corrected view','Initial Threshold','Chosen Threshold','Calculated VDP','VDP Estimate',
+                 'Quality Rank','Disease Guess','Disease Severity','Artifacts','Coil Shading','Segmentation Errors','Low SNR',
+                 'Slice Varying Threshold','Vascular Defects','Partial Voluming','Time to Review','Latency p50 (ms)','Latency p95 (ms)',
+                 'Latency max (ms)','Timings','Notes v240410_RPT','VDP Sweep',
+                 'Slice Thresholds','Defect Filter','Defect Clusters','Largest Cluster','Cluster Sizes','Cluster Sweep','Largest Cluster Sweep']
+
+## -- Defect filters (see criticalThresholds): a voxel is a defect when most of the voxels in this window around it
+## -- are below threshold. '2d3' is the original 3x3 in-plane median filter (medfilt2d)
+defectKernels = {'2d3': (3,3,1), '2d5': (5,5,1), '3d3': (3,3,3)}
+
+## -- Thresholds (fraction of the whole-lung mean) used for the VDP-vs-threshold sweep saved with every case
+sweepThresholds = np.round(np.arange(20,151)/100,2)
 
 #------------------------------------------------------------------------------------
 # -------------------------- HPG CLASS DEFINITION --------------------------------- ##
@@ -19,35 +43,257 @@ percentile (normHP), and a defect array given a certain threshold (defectArray).
 nice about classes is we can perform all of these calculations when we first create an
 HPG variable - so they're calculated upon variable assignment and don't need to be
 seprately run in the script."""
-    def __init__(self,HP,mask,N4HP):
+    # -- Version of the preprocessing below. Anything cached from derivedArrays() is keyed by this, so bump it
+    # -- whenever a change here would give different arrays
+    cacheVersion = 3
+
+    def __init__(self,HP,mask,N4HP,compact=False,defectKernel='2d3'):
         rows,cols,slices = self.cropToData(mask)
-        self.HP = HP[np.ix_(rows,cols,slices)]
-        self.mask = mask[np.ix_(rows,cols,slices)]
-        self.N4HP = N4HP[np.ix_(rows,cols,slices)]
+        if (len(rows),len(cols),len(slices)) == mask.shape:
+            # -- already cropped (e.g. from the case store) so we can use the arrays as they are without copying
+            self.HP, self.mask, self.N4HP = HP, mask, N4HP
+        else:
+            self.HP = HP[np.ix_(rows,cols,slices)]
+            self.mask = mask[np.ix_(rows,cols,slices)]
+            self.N4HP = N4HP[np.ix_(rows,cols,slices)]
+        # -- compact mode keeps the images as float32 and the mask as bool (1/2 and 1/8 the memory of float64)
+        self.compact = compact
+        self.defectKernel = defectKernel
+        if compact:
+            self.HP = self.HP.astype(np.float32,copy=False)
+            self.N4HP = self.N4HP.astype(np.float32,copy=False)
+            self.mask = self.mask>0
         self.normHP  = self.normalizeHP() # -- always performed on N4 data
-        self.HPmontage = self.HPtoMontage()
+        self.montages = {} # -- display montages we've already made, for the N4 (True) and raw (False) views
+        self.HPtoMontage()
+        self.maskBorder = self.calculateMaskBorder()
+        self.thresholdMap = self.calculateThresholdMap()
+        self.clusterSweep = None # -- calculated the first time it's used (see clusterCounts), most callers never need it
+        self.calculateDefectArray(0.6)
+
+    @classmethod
+    def fromArrays(cls,arrays):
+        '''Rebuilds an HPG from the output of derivedArrays() (e.g. from the artifact cache) without redoing any of the preprocessing'''
+        self = cls.__new__(cls)
+        self.compact = arrays['normHP'].dtype == np.float32
+        self.defectKernel = str(arrays['defectKernel']) if 'defectKernel' in arrays else '2d3'
+        for name in ('HP','mask','N4HP','normHP','maskBorder','thresholdMap'):
+            setattr(self,name,arrays[name])
+        self.montages = {}
+        if 'montageN4' in arrays: self.montages[True] = arrays['montageN4']
+        if 'montageRaw' in arrays: self.montages[False] = arrays['montageRaw']
+        self.HPtoMontage()
+        self.clusterSweep = (sweepThresholds,arrays['clusterCounts'],arrays['largestClusters']) if 'clusterCounts' in arrays else None
         self.calculateDefectArray(0.6)
+        return self
+
+    def derivedArrays(self):
+        '''All the arrays made by the (slow) preprocessing in __init__, in a dict that fromArrays() can rebuild the HPG from.
+            Both display montages and the cluster sweep are included so either view can be shown without recalculating'''
+        arrays = {name: getattr(self,name) for name in ('HP','mask','N4HP','normHP','maskBorder','thresholdMap','clusterCounts','largestClusters')}
+        arrays['montageN4'] = self.montageFor(True)
+        arrays['montageRaw'] = self.montageFor(False)
+        arrays['defectKernel'] = np.array(self.defectKernel)
+        return arrays
 
     def normalizeHP(self):
         '''The N4 bias corrected data are normalized to their mean signal value for analysis'''
         normHP = np.divide(self.N4HP,np.mean(self.N4HP[self.mask>0]))
+        if self.compact:
+            normHP = normHP.astype(np.float32,copy=False)
         return normHP
+
+    def memoryFootprint(self):
+        '''Bytes of memory used by this HPG's arrays. Memory mapped arrays (from the case store or cache) aren't counted
+            since the OS pages those in and out of the files as needed'''
+        arrays = [x for x in vars(self).values() if isinstance(x,np.ndarray)] + list(self.montages.values())
+        arrays = {id(x): x for x in arrays if not isinstance(x,np.memmap)}
+        return sum(x.nbytes for x in arrays.values())
     
+    def calculateThresholdMap(self):
+        '''The defect array is the median filter (by default 3x3 in-plane, like medfilt2d, zero padded) of the binary array
+            (normHP<thresh)*mask. A median of 9 binary values is just a majority vote, so a voxel becomes a defect as soon as
+            5 of its 9 in-plane neighbors are below threshold. Every voxel therefore has a single 'critical' threshold (the
+            5th smallest of its neighbors) above which it's a defect. We calculate that map once here so threshold changes are
+            just a comparison. Neighbors outside the mask (and the zero padding) can never be below threshold, so they're inf.
+            Other filters (defectKernel, see defectKernels) work the same way with their own window.'''
+        values = np.where(self.mask>0,self.normHP,np.inf)
+        values[np.isnan(values)] = np.inf
+        return criticalThresholds(values,self.defectKernel)
+
+    def calculateMaskBorder(self):
+        '''The border of the mask (for display): wherever the in-plane gradient of the mask isn't zero. The mask doesn't
+            change with threshold so this is done once per case (and cached with the other arrays)'''
+        gradients = np.gradient(self.mask.astype(np.float32),axis=(0,1))
+        return (gradients[0]!=0) | (gradients[1]!=0)
+
     def calculateDefectArray(self,thresh):
         '''given a threshold (specified as a fraction of the whole-lung signal mean) create the 3D binary defect array.
-            Two arrays are created: the defect Array, and the border of the defect array (maybe helpful, idk...)'''
-        defectArray = np.zeros(self.normHP.shape)
-        for k in range(self.mask.shape[2]):
-            defectArray[:,:,k] = medfilt2d((self.normHP[:,:,k]<thresh)*self.mask[:,:,k])
-        maskBorder = np.zeros(self.normHP.shape)
-        for k in range(self.mask.shape[2]):
-            x = np.gradient(self.mask[:,:,k].astype(float))
-            maskBorder[:,:,k] = (x[0]!=0)+(x[1]!=0)
-        #self.defectBorder = defectBorder
-        #self.defectArray = defectArray
-        self.VDP = np.sum(defectArray)/np.sum(self.mask)*100
+            This gives the same result as median filtering (normHP<thresh)*mask slice by slice, but uses the precomputed
+            thresholdMap so it's a single comparison (see calculateThresholdMap)'''
+        defectArray = self.thresholdMap < thresh
+        self.nMask = np.count_nonzero(self.mask)
+        self.nDefect = np.count_nonzero(defectArray)
+        self.VDP = self.nDefect/self.nMask*100
         self.defectArray = defectArray
-        self.maskBorder = maskBorder
+        self.sliceThresholds = np.full(self.mask.shape[2],float(thresh))
+
+    def calculateDefectArrayPerSlice(self,thresholds):
+        '''Same as calculateDefectArray but with a different threshold for every slice (a list, one per slice).
+            (With the '3d3' filter a slice's threshold is also applied to its neighbors from the slices either side)'''
+        self.sliceThresholds = np.array(thresholds,dtype=float)
+        self.defectArray = self.thresholdMap < self.sliceThresholds[None,None,:]
+        self.nMask = np.count_nonzero(self.mask)
+        self.nDefect = np.count_nonzero(self.defectArray)
+        self.VDP = self.nDefect/self.nMask*100
+
+    def calculateSliceDefects(self,k,thresh):
+        '''Changes the threshold of slice k only: recalculates that slice's defects and updates the whole-lung VDP
+            from the change in that slice's defect count (the rest of the defect array isn't touched)'''
+        oldCount = np.count_nonzero(self.defectArray[:,:,k])
+        self.defectArray[:,:,k] = self.thresholdMap[:,:,k] < thresh
+        self.nDefect += np.count_nonzero(self.defectArray[:,:,k]) - oldCount
+        self.sliceThresholds[k] = thresh
+        self.VDP = self.nDefect/self.nMask*100
+
+    def thresholdSweep(self,thresholds=sweepThresholds):
+        '''Returns the VDP at every threshold in one pass. A voxel is a defect when its thresholdMap value is below
+            the threshold, so once the map is sorted the number of defect voxels at any threshold is just a searchsorted.'''
+        sortedMap = np.sort(self.thresholdMap,axis=None)
+        nDefect = np.searchsorted(sortedMap,thresholds,side='left')
+        return nDefect/np.count_nonzero(self.mask)*100
+
+    def calculateClusterSweep(self,thresholds=sweepThresholds):
+        '''Number of defect clusters (3D, face connected) and the size of the largest one (voxels) at every threshold, in
+            one pass. Voxels are added in order of their thresholdMap value (the threshold at which they become defects) and
+            the clusters they touch are merged, union-find style. All the merges between two sweep thresholds are done
+            together as one connected components step on the graph of the current clusters, so it's a few numpy calls per
+            threshold instead of a relabelling of the whole defect array (or a Python loop over voxels).'''
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        voxelThresh = self.thresholdMap.ravel()
+        # -- only voxels that are defects at some threshold in the sweep, numbered in the order they become defects
+        # -- (a stable sort of small ints is a radix sort, much quicker than sorting the thresholds themselves)
+        nodes = np.flatnonzero(voxelThresh < thresholds[-1])
+        nodeStep = np.searchsorted(thresholds,voxelThresh[nodes],side='right').astype(np.int16) # -- first sweep threshold it's a defect at
+        order = np.argsort(nodeStep,kind='stable')
+        nodes, nodeStep = nodes[order], nodeStep[order]
+        nodeOf = np.full(voxelThresh.size,-1)
+        nodeOf[nodes] = np.arange(len(nodes))
+        nodeOf = nodeOf.reshape(self.thresholdMap.shape)
+        # -- face neighbors along each axis, joined once both of them are defects
+        a, b = [], []
+        for axis in range(3):
+            neighbors = np.moveaxis(nodeOf,axis,0)
+            first, second = neighbors[:-1].ravel(), neighbors[1:].ravel()
+            both = (first>=0) & (second>=0)
+            a.append(first[both])
+            b.append(second[both])
+        a, b = np.concatenate(a), np.concatenate(b)
+        edgeStep = np.maximum(nodeStep[a],nodeStep[b])
+        order = np.argsort(edgeStep,kind='stable')
+        a, b = a[order], b[order]
+        edgeStarts = np.searchsorted(edgeStep[order],np.arange(len(thresholds)+1))
+        nActive = np.searchsorted(nodeStep,np.arange(len(thresholds)),side='right')
+
+        clusterCounts = np.zeros(len(thresholds),dtype=np.int32)
+        largestClusters = np.zeros(len(thresholds),dtype=np.int32)
+        parent = np.arange(len(nodes)) # -- union-find forest: a voxel's cluster is the root of its tree
+        size = np.ones(len(nodes),dtype=np.int64) # -- cluster sizes, only meaningful at roots
+        nClusters, largest = 0, 0
+        for k in range(len(thresholds)):
+            nClusters += nActive[k] - (nActive[k-1] if k else 0)
+            if nActive[k]:
+                largest = max(largest,1)
+            if edgeStarts[k+1] > edgeStarts[k]:
+                newEdges = slice(edgeStarts[k],edgeStarts[k+1])
+                rootA, rootB = findRoots(parent,a[newEdges]), findRoots(parent,b[newEdges])
+                # -- merge the clusters these edges join (only those clusters are touched, however big the lungs are)
+                roots, local = np.unique(np.concatenate([rootA,rootB]),return_inverse=True)
+                graph = coo_matrix((np.ones(len(rootA),dtype=bool),(local[:len(rootA)],local[len(rootA):])),shape=(len(roots),len(roots)))
+                nMerged, component = connected_components(graph,directed=False)
+                newRoots = np.zeros(nMerged,dtype=roots.dtype)
+                newRoots[component] = roots # -- any member can be the new root
+                mergedSizes = np.bincount(component,weights=size[roots]).astype(np.int64)
+                parent[roots] = newRoots[component]
+                size[newRoots] = mergedSizes
+                nClusters -= len(roots) - nMerged
+                largest = max(largest,mergedSizes.max())
+            clusterCounts[k] = nClusters
+            largestClusters[k] = largest
+        self.clusterSweep = (thresholds,clusterCounts,largestClusters)
+
+    @property
+    def clusterThresholds(self):
+        '''The thresholds of the cluster sweep. This and clusterCounts/largestClusters run calculateClusterSweep the
+            first time any of them is used'''
+        if self.clusterSweep is None:
+            self.calculateClusterSweep()
+        return self.clusterSweep[0]
+
+    @property
+    def clusterCounts(self):
+        if self.clusterSweep is None:
+            self.calculateClusterSweep()
+        return self.clusterSweep[1]
+
+    @property
+    def largestClusters(self):
+        if self.clusterSweep is None:
+            self.calculateClusterSweep()
+        return self.clusterSweep[2]
+
+    def defectClusters(self):
+        '''Sizes (voxels) of all the defect clusters (3D, face connected) in the current defectArray, largest first'''
+        from scipy.ndimage import label
+        labels, _ = label(self.defectArray)
+        return np.sort(np.bincount(labels.ravel())[1:])[::-1]
+
+    def clusterStats(self,sizes=None):
+        '''(number of defect clusters, largest cluster in voxels) for the current defectArray. For a single threshold in
+            the sweep this is a lookup from calculateClusterSweep. Otherwise (per-slice thresholds, off-sweep thresholds)
+            it comes from sizes (from defectClusters) if given, or is (None, None) - labelling the whole volume is too
+            slow to do on every threshold or scroll event, so that's left for saving'''
+        thresh = self.sliceThresholds[0]
+        k = np.searchsorted(self.clusterThresholds,thresh-1e-9)
+        if np.all(self.sliceThresholds == thresh) and k < len(self.clusterThresholds) and np.isclose(self.clusterThresholds[k],thresh):
+            return int(self.clusterCounts[k]), int(self.largestClusters[k])
+        if sizes is None:
+            return None, None
+        return len(sizes), int(sizes[0]) if len(sizes) else 0
+
+    def resultFields(self,sliceThresholds=None):
+        '''The calculated columns of a case's results for the current defectArray (VDP, sweeps, filter and clusters), keyed
+            by column header. sliceThresholds (percent) are the per-slice thresholds if they're in use. Used by both the
+            GUI and the review server, so the two always save the same thing'''
+        sizes = self.defectClusters() # -- label once, for both the cluster count and the size distribution
+        fields = {'Calculated VDP': self.VDP,
+                  'VDP Sweep': formatSweep(self.thresholdSweep()),
+                  'Slice Thresholds': formatSliceThresholds(sliceThresholds) if sliceThresholds is not None else '',
+                  'Defect Filter': self.defectKernel}
+        fields['Defect Clusters'], fields['Largest Cluster'] = self.clusterStats(sizes)
+        fields['Cluster Sizes'] = formatClusterSizes(sizes)
+        fields['Cluster Sweep'] = formatSweep(self.clusterCounts,self.clusterThresholds,valueFormat='d')
+        fields['Largest Cluster Sweep'] = formatSweep(self.largestClusters,self.clusterThresholds,valueFormat='d')
+        return fields
+
+    def referenceThresholds(self,maFraction=0.6,lbMean=0.52,lbSD=0.18,nClusters=4):
+        '''Defect thresholds from the literature methods, in the same units as the GUI (fraction of the whole-lung mean
+            of the N4 data) so they can be compared directly with the reader's chosen threshold:
+             - mean anchored (MA): maFraction of the mean
+             - linear binning (LB): signal normalized to its 99th percentile, defects below the healthy reference lbMean - 2*lbSD
+             - k-means (KM): 1-D k-means with nClusters clusters, defects in the lowest (threshold halfway between the lowest 2 centers)
+            The VDP for each is calculated the same way as the reader's (with the same median filter), from the threshold map.'''
+        voxels = self.normHP[self.mask>0]
+        voxels = voxels[np.isfinite(voxels)]
+        k = int(0.99*len(voxels))
+        p99 = np.partition(voxels,k)[k]
+        centers = kmeans1D(voxels,nClusters)
+        thresholds = {'MA': maFraction,
+                      'LB': (lbMean-2*lbSD)*p99,
+                      'KM': (centers[0]+centers[1])/2}
+        VDPs = self.thresholdSweep(np.array(list(thresholds.values())))
+        return {name: (float(thresholds[name]),float(VDP)) for name, VDP in zip(thresholds,VDPs)}
 
     def normalize95th(self):
         '''Normalize the HP array to its 95th percentile value. This is only for display in the GUI - no analysis is performed on these'''
@@ -60,35 +306,65 @@ seprately run in the script."""
         return norm95HP
 
     def HPtoMontage(self,useBias=True):
-        '''inputs 3D HP and returns 8bit 2D montage normalized to 95th for display'''
-        if useBias:
-            voxlist = self.N4HP[self.mask>0]
-            voxlist.sort()
-            HPimage = np.divide(self.N4HP,voxlist[int(0.99*len(voxlist))])
-        else:
-            voxlist = self.HP[self.mask>0]
-            voxlist.sort()
-            HPimage = np.divide(self.HP,voxlist[int(0.99*len(voxlist))])
-        HPimage[HPimage>1] = 1
-        HPimage = HPimage*255
-        HPimage = HPimage.astype(np.uint8)
-        l = [list(x) for x in HPimage.transpose(1,2,0).swapaxes(0,2)]
-        self.HPmontage = np.block(l)
+        '''Sets HPmontage to the 8bit 2D montage (N4 corrected or raw HP) normalized to 99th percentile for display'''
+        self.HPmontage = self.montageFor(useBias)
+
+    def montageFor(self,useBias):
+        '''inputs 3D HP and returns 8bit 2D montage normalized to 99th percentile for display. Each montage is only made once'''
+        useBias = bool(useBias)
+        if useBias not in self.montages:
+            image = self.N4HP if useBias else self.HP
+            voxlist = image[self.mask>0]
+            k = int(0.99*len(voxlist))
+            HPimage = np.divide(image,np.partition(voxlist,k)[k]) # -- same as sorting and taking voxlist[k], but faster
+            HPimage[HPimage>1] = 1
+            HPimage = HPimage*255
+            HPimage = HPimage.astype(np.uint8)
+            self.montages[useBias] = self.montage(HPimage)
+        return self.montages[useBias]
     
     def defectMontage(self,border=False):
-        '''creates a 3D RGB array of the montaged data and mask for display'''
-        combined3D = np.zeros((self.HPmontage.shape[0],self.HPmontage.shape[1],3))
-        defectMontage = self.montage(self.defectArray)
-        maskMontage = self.montage(self.maskBorder)
+        '''creates a 3D RGB array of the montaged data and mask for display (all slices - see composeView for just a few)'''
+        out = np.empty(self.HPmontage.shape+(3,),dtype=np.uint8)
+        return self.composeView(0,self.HPmontage.shape[1]//self.HP.shape[1],border,out)
+
+    def composeView(self,firstSlice,lastSlice,border=False,out=None,changedSlices=None):
+        '''creates the RGB display montage for slices firstSlice up to (not including) lastSlice: the HP montage with defects
+            in red and, if border is True, the mask border in blue/orange. The image is written in place into a buffer that is
+            reused between calls (unless you give your own 'out'), so don't hold on to the result past the next call.
+            If only some slices' defects changed since the last call for the same view, pass them as changedSlices and
+            only those tiles are redrawn.'''
+        nRows, nCol = self.HP.shape[0], self.HP.shape[1]
+        nSlices = lastSlice - firstSlice
+        if out is None:
+            if getattr(self,'viewBuffer',None) is None or self.viewBuffer.shape != (nRows,nSlices*nCol,3):
+                self.viewBuffer = np.empty((nRows,nSlices*nCol,3),dtype=np.uint8)
+                self.viewState = None
+            out = self.viewBuffer
+            viewState, self.viewState = self.viewState, (firstSlice,lastSlice,border,self.HPmontage is self.montages.get(True))
+            if changedSlices is not None and viewState == self.viewState:
+                view = out.reshape(nRows,nSlices,nCol,3)
+                for k in changedSlices:
+                    if firstSlice <= k < lastSlice:
+                        self.composeTiles(view[:,k-firstSlice:k-firstSlice+1],k,k+1,border)
+                return out
+        self.composeTiles(out.reshape(nRows,nSlices,nCol,3),firstSlice,lastSlice,border)
+        return out
+
+    def composeTiles(self,view,firstSlice,lastSlice,border):
+        '''Draws slices firstSlice to lastSlice into view, a [rows, slices, cols, RGB] array (see composeView)'''
+        nRows, nCol = self.HP.shape[0], self.HP.shape[1]
+        nSlices = lastSlice - firstSlice
+        # -- everything below works on [rows, slices, cols] views of the data so nothing gets montaged (copied) first
+        gray = self.HPmontage[:,firstSlice*nCol:lastSlice*nCol].reshape(nRows,nSlices,nCol)
+        defects = self.defectArray[:,:,firstSlice:lastSlice].transpose(0,2,1)
+        np.copyto(view,gray[:,:,:,None])
+        np.copyto(view,defectColor,where=defects[:,:,:,None])
         if border:
-            combined3D[:,:,0] = self.HPmontage*(defectMontage==0)*(maskMontage==0) + 255*(defectMontage==1)
-            combined3D[:,:,1] = self.HPmontage*(defectMontage==0)*(maskMontage==0) + 128*(maskMontage==1)
-            combined3D[:,:,2] = self.HPmontage*(defectMontage==0)*(maskMontage==0) + 255*(maskMontage==1)
-        else:
-            combined3D[:,:,0] = self.HPmontage*(defectMontage==0) + 255*(defectMontage==1)
-            combined3D[:,:,1] = self.HPmontage*(defectMontage==0)
-            combined3D[:,:,2] = self.HPmontage*(defectMontage==0)
-        return combined3D.astype(np.uint8)
+            maskBorder = self.maskBorder[:,:,firstSlice:lastSlice].transpose(0,2,1)
+            np.copyto(view[:,:,:,1:],borderColor[1:],where=maskBorder[:,:,:,None])
+            np.copyto(view[:,:,:,0],0,where=maskBorder)
+            np.copyto(view[:,:,:,0],255,where=defects) # -- where a defect is on the border it keeps its red
     
     def borderMontage(self):
         '''same as above but for the border array (not sure why I made the same function twice, but I did...)'''
@@ -101,16 +377,15 @@ seprately run in the script."""
 
     def montage(self,arr):
         '''inputs 3D array [rows, cols, slices], returns 2D array montage [rows,cols*slices]'''
-        l = [list(x) for x in arr.transpose(1,2,0).swapaxes(0,2)]
-        montage = np.block(l)
-        return montage
+        return arr.transpose(0,2,1).reshape(arr.shape[0],arr.shape[1]*arr.shape[2])
 
-    def cropToData(self,A):
+    @staticmethod
+    def cropToData(A):
         '''Given a binary array (mask) will return the rows/columns/slices in which data exist.
             This allows us to crop out the empty rows/cols/slices for better display'''
-        slices = np.multiply(np.sum(np.sum(A,axis=0),axis=0)>0,list(range(0,A.shape[2])))
-        rows = np.multiply(np.sum(np.sum(A,axis=1),axis=1)>0,list(range(0,A.shape[0])))
-        cols = np.multiply(np.sum(np.sum(A,axis=2),axis=0)>0,list(range(0,A.shape[1])))
+        slices = np.sum(np.sum(A,axis=0),axis=0)>0
+        rows = np.sum(np.sum(A,axis=1),axis=1)>0
+        cols = np.sum(np.sum(A,axis=2),axis=0)>0
         slices = [x for x in range(0,A.shape[2]) if slices[x]]
         rows = [x for x in range(0,A.shape[0]) if rows[x]]
         cols = [x for x in range(0,A.shape[1]) if cols[x]]
@@ -118,10 +393,624 @@ seprately run in the script."""
         return rows, cols, slices
 
 
+## ---------------------------------------------- ## 
+## -------- Defect filters and clusters --------- ##
+## ---------------------------------------------- ## 
+
+def findRoots(parent,x):
+    '''Union-find 'find' for an array of elements at once: follows parent pointers to the roots and points every
+        element straight at its root (path compression) so later finds are quick'''
+    roots = parent[x]
+    while True:
+        grandparents = parent[roots]
+        if np.array_equal(grandparents,roots):
+            break
+        roots = grandparents
+    parent[x] = roots
+    return roots
+
+def criticalThresholds(values,kernel='2d3',chunkVoxels=2**22):
+    '''The defect filter engine. For a majority (median) filter of a binary array, a voxel is 1 when more than half
+        of the n values in its window are 1, so with values thresholded at t the voxel is a defect exactly when the
+        (n//2)th smallest value in its window (counting from 0) is below t. This returns that value for every voxel
+        of a 3D array, for any window in defectKernels, zero padded like medfilt (the padding is inf, never a defect).
+        The whole volume is one sliding window view and partition, done in slabs of slices so the n copies
+        of the volume stay under about chunkVoxels values'''
+    window = defectKernels[kernel]
+    rank = int(np.prod(window))//2
+    padded = np.pad(values,[(w//2,w//2) for w in window],constant_values=np.inf)
+    out = np.empty(values.shape,dtype=values.dtype)
+    nSlices = values.shape[2]
+    slab = max(1,chunkVoxels//(values.shape[0]*values.shape[1]*int(np.prod(window))))
+    for first in range(0,nSlices,slab):
+        last = min(nSlices,first+slab)
+        neighbors = sliding_window_view(padded[:,:,first:last+window[2]-1],window) # -- [rows, cols, slices, window...]
+        neighbors = neighbors.reshape(neighbors.shape[:3]+(-1,))
+        out[:,:,first:last] = np.partition(neighbors,rank,axis=3)[:,:,:,rank]
+    return out
+
+## ---------------------------------------------- ## 
+## ------------ Reference thresholds ------------ ##
+## ---------------------------------------------- ## 
+
+def kmeans1D(values,nClusters=4,nBins=1024,maxIterations=100):
+    '''k-means on a 1-D list of values, done on its histogram instead of on every value (so it costs the same for any
+        number of voxels). Returns the sorted cluster centers'''
+    top = np.quantile(values,0.999)
+    counts, edges = np.histogram(np.clip(values,0,top),bins=nBins,range=(0,top))
+    binCenters = (edges[:-1]+edges[1:])/2
+    centers = np.quantile(values,(np.arange(nClusters)+0.5)/nClusters) # -- start evenly spread through the data
+    for _ in range(maxIterations):
+        # -- with sorted 1-D centers each cluster is just a range of bins between midpoints
+        cluster = np.searchsorted((centers[:-1]+centers[1:])/2,binCenters)
+        weights = np.bincount(cluster,weights=counts,minlength=nClusters)
+        sums = np.bincount(cluster,weights=counts*binCenters,minlength=nClusters)
+        newCenters = np.where(weights>0,sums/np.maximum(weights,1),centers)
+        newCenters.sort()
+        if np.allclose(newCenters,centers):
+            break
+        centers = newCenters
+    return newCenters
+
+def referenceThresholdsForFile(path):
+    '''Loads one 4D Nifti and returns {'File', 'MA threshold', 'MA VDP', 'LB threshold', ...} (see HPG.referenceThresholds)'''
+    nii_data, _, _ = load_Nifti_file(path,dtype=np.float32)
+    HPG1 = HPG(nii_data[:,:,:,0],nii_data[:,:,:,1],nii_data[:,:,:,2],compact=True)
+    del nii_data
+    result = {'File': os.path.basename(path)}
+    for name, (threshold, VDP) in HPG1.referenceThresholds().items():
+        result[f'{name} threshold'] = threshold
+        result[f'{name} VDP'] = VDP
+    return result
+
+def referenceThresholdsForFolder(folder,workers=None):
+    '''Reference thresholds for every Nifti in a folder, using a pool of worker processes (default: one per core).
+        Returns a list of dicts (see referenceThresholdsForFile) in file name order'''
+    from concurrent.futures import ProcessPoolExecutor
+    fileList = sorted(os.listdir(folder))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(referenceThresholdsForFile,[os.path.join(folder,f) for f in fileList],chunksize=4))
+    return results
+
+
+## ---------------------------------------------- ## 
+## -------------- Case prefetching -------------- ##
+## ---------------------------------------------- ## 
+
+class CaseLoadCancelled(Exception):
+    """Raised by CasePrefetcher.checkCancelled() in a case that's being loaded when the prefetcher is closed"""
+
+
+class CasePrefetcher:
+    """Loads and prepares the next case(s) in a background thread while the reader is looking at the current one.
+loadCase is any function that takes a worksheet row and returns a ready-to-display HPG. Cases
+are prepared in worksheet order, up to 'depth' cases ahead, as long as the prepared cases fit in memoryBudget
+(bytes). Call close() when the app closes so nothing queued keeps running. A case that's already being loaded
+can't be interrupted from outside, so loadCase should call checkCancelled() between its slow stages - then
+closing mid-load only waits for the current stage, not the whole case."""
+    def __init__(self,loadCase,caseOrder,depth=1,memoryBudget=1e9):
+        self.loadCase = loadCase
+        self.caseOrder = list(caseOrder)
+        self.depth = depth
+        self.memoryBudget = memoryBudget
+        self.caseBytes = 0 # -- size of the last prepared case, our guess for the next one
+        self.futures = {}
+        self.closed = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='prefetch')
+
+    def get(self,k):
+        '''Returns the prepared case for row k (waits if it's still loading, loads it now if it was never queued)
+            and starts preparing the cases after it'''
+        future = self.futures.pop(k,None)
+        if future is None or future.cancelled():
+            case = self.loadCase(k)
+        else:
+            case = future.result()
+        self.caseBytes = case.memoryFootprint()
+        self.prefetchAfter(k)
+        return case
+
+    def request(self,k):
+        '''Starts preparing row k now, if it isn't already (e.g. the first case, so the window can open meanwhile)'''
+        if k not in self.futures:
+            self.futures[k] = self.executor.submit(self.loadCase,k)
+
+    def ready(self,k):
+        '''True if get(k) would return without waiting'''
+        future = self.futures.get(k)
+        return future is not None and future.done()
+
+    def prefetchAfter(self,k):
+        '''Queues the next 'depth' cases after row k, dropping anything that isn't coming up anymore'''
+        if k in self.caseOrder:
+            position = self.caseOrder.index(k)
+            upcoming = self.caseOrder[position+1:position+1+self.depth]
+        else:
+            upcoming = []
+        for j in list(self.futures):
+            if j not in upcoming:
+                self.futures.pop(j).cancel()
+        for j in upcoming:
+            if j in self.futures:
+                continue
+            # -- every prepared (or preparing) case counts against the budget, plus the one we'd be adding
+            if (len(self.futures)+1)*self.caseBytes > self.memoryBudget:
+                break
+            self.futures[j] = self.executor.submit(self.loadCase,j)
+
+    def checkCancelled(self):
+        '''For loadCase to call between stages: raises CaseLoadCancelled once the prefetcher has been closed'''
+        if self.closed.is_set():
+            raise CaseLoadCancelled()
+
+    def close(self):
+        '''Cancels anything queued, and tells a case being loaded to stop at its next checkCancelled()'''
+        self.closed.set()
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.executor.shutdown(wait=False,cancel_futures=True)
+
+
+## ---------------------------------------------- ## 
+## ------------- Display rendering -------------- ##
+## ---------------------------------------------- ## 
+
+class RenderWorker:
+    """Renders the display images in a background thread so the window stays responsive while you scroll.
+Each submit() replaces whatever was waiting to be rendered, so a burst of wheel/slider events only renders
+the latest state - the ones in between are skipped. Finished renders come back to the GUI loop as an event
+(eventKey) with a dict of the state that was rendered, its VDP and the two PIL images. The images still have
+to be put on screen by the GUI thread (showImage) since tkinter isn't thread safe. A render that fails comes back
+as an errorKey event instead (the state's generation, the exception and its traceback) and the worker carries on
+with the next one. While the worker is running it's the only thing touching the HPG, so call waitIdle() before
+using the HPG yourself."""
+    def __init__(self,window,HPG,sliceRange,eventKey='-RENDERED-',errorKey='-RENDERERROR-',profiler=None):
+        self.window = window
+        self.profiler = profiler # -- SessionProfiler, renders are profiled in this thread if given
+        self.HPG = HPG
+        self.sliceRange = sliceRange
+        self.eventKey = eventKey
+        self.errorKey = errorKey
+        self.generation = 0 # -- counts submits, so the GUI can tell which render is the newest
+        self.pending = None
+        self.busy = False
+        self.closed = False
+        self.renderedThreshold = None
+        self.renderedSlices = None
+        self.display = None # -- DisplayCache of the current case, made on its first render
+        self.renderedFirst = None # -- first slice of the raw image last sent
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run,daemon=True,name='render')
+        self.thread.start()
+
+    def setCase(self,HPG):
+        '''Switches to rendering a new HPG (waits for any render of the old one to finish first)'''
+        self.waitIdle()
+        with self.condition:
+            self.HPG = HPG
+            self.renderedThreshold = None
+            self.renderedSlices = None
+            self.display = None
+            self.renderedFirst = None
+
+    def submit(self,threshold,slider_value,showBorder,sliceThresholds=None,event='threshold'):
+        '''Asks for the display at this threshold (percent of the mean), slider position and border setting.
+            sliceThresholds (one per slice, percent) switches to per-slice thresholds instead of the single threshold.
+            event names what caused it, and the result's submittedAt is the perf_counter time of the oldest event it
+            answers (skipped renders included), so (showing time - submittedAt) is the event-to-pixels latency'''
+        with self.condition:
+            self.generation += 1
+            submittedAt = time.perf_counter() if self.pending is None else self.pending['submittedAt']
+            self.pending = {'generation': self.generation, 'threshold': threshold, 'slider_value': slider_value, 'showBorder': showBorder,
+                            'sliceThresholds': None if sliceThresholds is None else tuple(sliceThresholds),
+                            'event': event, 'submittedAt': submittedAt}
+            self.condition.notify_all()
+        return self.generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.closed)
+                if self.closed:
+                    return
+                state, self.pending = self.pending, None
+                self.busy = True
+            eventKey = self.eventKey
+            try:
+                start = time.perf_counter()
+                if self.profiler is None:
+                    result = self.render(state)
+                else:
+                    with self.profiler.profiled():
+                        result = self.render(state)
+                result['renderSeconds'] = time.perf_counter()-start
+            except Exception as e:
+                # -- don't let the thread die (every later submit would be left pending): tell the GUI and start
+                # -- the next render from scratch, since this one may have stopped half way through
+                eventKey = self.errorKey
+                result = {'generation': state['generation'], 'error': e, 'traceback': traceback.format_exc()}
+                self.display, self.renderedThreshold, self.renderedSlices, self.renderedFirst = None, None, None, None
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+                    closed = self.closed
+            if not closed:
+                self.window.write_event_value(eventKey,result)
+
+    def render(self,state):
+        '''Does all the work for one display update: defects and display tiles, only where thresholds changed.
+            rawImage is None when it's the same as the last one sent (the raw images only change with the slider)'''
+        if self.display is None:
+            self.display = DisplayCache(self.HPG)
+        if state['sliceThresholds'] is None:
+            if state['threshold'] != self.renderedThreshold or self.renderedSlices is not None:
+                self.HPG.calculateDefectArray(state['threshold']/100)
+                self.display.invalidate()
+                self.renderedThreshold = state['threshold']
+                self.renderedSlices = None
+        elif self.renderedSlices is None and self.renderedThreshold is None:
+            self.HPG.calculateDefectArrayPerSlice(np.array(state['sliceThresholds'])/100)
+            self.display.invalidate()
+            self.renderedSlices = state['sliceThresholds']
+        else:
+            # -- per-slice thresholds: only the slices whose threshold changed get recalculated (and redrawn)
+            previous = self.renderedSlices or (self.renderedThreshold,)*len(state['sliceThresholds'])
+            changedSlices = [k for k in range(len(previous)) if previous[k] != state['sliceThresholds'][k]]
+            for k in changedSlices:
+                self.HPG.calculateSliceDefects(k,state['sliceThresholds'][k]/100)
+            self.display.invalidate(changedSlices)
+            self.renderedSlices = state['sliceThresholds']
+        first, last = state['slider_value']-self.sliceRange, state['slider_value']+self.sliceRange
+        result = dict(state)
+        result['VDP'] = self.HPG.VDP
+        result['nClusters'], result['largestCluster'] = self.HPG.clusterStats()
+        result['rawImage'] = self.display.rawImage(first,last) if first != self.renderedFirst else None
+        result['defectImage'] = self.display.defectImage(first,last,border=state['showBorder'])
+        self.renderedFirst = first
+        return result
+
+    def waitIdle(self):
+        '''Blocks until nothing is waiting to be rendered and the current render (if any) is done. Raises
+            RuntimeError if the render thread has stopped, rather than waiting forever'''
+        with self.condition:
+            while not self.condition.wait_for(lambda: not self.busy and (self.pending is None or self.closed),timeout=0.5):
+                if not self.thread.is_alive():
+                    raise RuntimeError('The render thread has stopped')
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending = None
+            self.condition.notify_all()
+
+
+class DisplayCache:
+    """Display tiles for one case, already scaled to the window (nPixels high). The raw image tiles are scaled once when
+the case is opened, and each slice's defect overlay tile is drawn and scaled only when that slice's defects change
+(invalidate) - so scrolling through slices just copies tiles that are already made, plus at most the one or two
+newly visible overlay tiles. Tiles are scaled one slice at a time, so they can differ from scaling the whole
+montage (renderImage) by a pixel or so of interpolation at the slice edges."""
+    def __init__(self,HPG,nPixels=200):
+        self.HPG = HPG
+        self.nPixels = nPixels
+        nRows, nCol, nSlices = HPG.HP.shape
+        self.tileWidth = displayTileWidth(nRows,nCol,nPixels)
+        self.rawTiles = np.empty((nPixels,nSlices*self.tileWidth),dtype=np.uint8)
+        for k in range(nSlices):
+            self.rawTiles[:,self.tileSlice(k)] = self.scaleTile(HPG.HPmontage[:,k*nCol:(k+1)*nCol])
+        self.defectTiles = np.empty((nPixels,nSlices*self.tileWidth,3),dtype=np.uint8)
+        self.valid = np.zeros(nSlices,dtype=bool) # -- which defect tiles are up to date
+        self.border = None
+        self.tileBuffer = np.empty((nRows,1,nCol,3),dtype=np.uint8)
+
+    def tileSlice(self,k):
+        return slice(k*self.tileWidth,(k+1)*self.tileWidth)
+
+    def scaleTile(self,A):
+        return np.asarray(Image.fromarray(A.astype(np.uint8,copy=False)).resize((self.tileWidth,self.nPixels)))
+
+    def invalidate(self,slices=None):
+        '''Marks the defect tiles of these slices (all slices if None) as needing a redraw'''
+        if slices is None:
+            self.valid[:] = False
+        else:
+            self.valid[list(slices)] = False
+
+    def rawImage(self,firstSlice,lastSlice):
+        return Image.fromarray(self.rawTiles[:,firstSlice*self.tileWidth:lastSlice*self.tileWidth])
+
+    def defectImage(self,firstSlice,lastSlice,border=False):
+        if border != self.border:
+            self.invalidate()
+            self.border = border
+        for k in range(firstSlice,lastSlice):
+            if not self.valid[k]:
+                self.HPG.composeTiles(self.tileBuffer,k,k+1,border)
+                self.defectTiles[:,self.tileSlice(k)] = self.scaleTile(self.tileBuffer[:,0])
+                self.valid[k] = True
+        return Image.fromarray(self.defectTiles[:,firstSlice*self.tileWidth:lastSlice*self.tileWidth])
+
+
+class Instrumentation:
+    """Timings of everything the reader waits for (event-to-pixels latency of threshold and slider changes, case
+loading and preprocessing, saving). record() just drops (when, case, kind, seconds) into a fixed size ring buffer,
+which is written to the session log whenever it fills up and at flush(), so it costs next to nothing while you
+scroll. Timings are also kept by case so caseSummary() can give the p50/p95/max saved with each case.
+It's safe to record from any thread."""
+    def __init__(self,logPath=None,capacity=1024):
+        self.logPath = logPath
+        self.capacity = capacity
+        self.ring = [None]*capacity
+        self.count = 0 # -- total records so far; record n is in ring[n % capacity]
+        self.flushed = 0 # -- records up to here are already in the log
+        self.byCase = {}
+        self.lock = threading.Lock()
+        if logPath is not None:
+            os.makedirs(os.path.dirname(logPath),exist_ok=True)
+            with open(logPath,'a') as f:
+                f.write('time\tcase\tkind\tms\n')
+
+    def record(self,kind,seconds,case=None):
+        with self.lock:
+            self.ring[self.count % self.capacity] = (time.time(),case,kind,seconds)
+            self.count += 1
+            self.byCase.setdefault(case,{}).setdefault(kind,[]).append(seconds)
+            if self.count - self.flushed >= self.capacity:
+                self.flushLocked()
+
+    @contextmanager
+    def timed(self,kind,case=None):
+        '''with instruments.timed('load',k): ... records how long the block took'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind,time.perf_counter()-start,case)
+
+    def flush(self):
+        '''Writes any records not yet in the session log'''
+        with self.lock:
+            self.flushLocked()
+
+    def flushLocked(self):
+        records = [self.ring[n % self.capacity] for n in range(self.flushed,self.count)]
+        self.flushed = self.count
+        if self.logPath is None or not records:
+            return
+        with open(self.logPath,'a') as f:
+            f.writelines(f"{time.strftime('%H:%M:%S',time.localtime(when))}\t{case}\t{kind}\t{1000*seconds:.2f}\n" for when, case, kind, seconds in records)
+
+    def caseSummary(self,case,latencyKinds=('threshold','slider','border')):
+        '''Returns ((p50, p95, max) event-to-pixels latency in ms over latencyKinds, "kind:p50/p95/max,..." for every
+            kind of timing) for one case, and forgets that case'''
+        with self.lock:
+            timings = self.byCase.pop(case,{})
+        def stats(seconds):
+            ms = 1000*np.array(seconds)
+            return round(float(np.percentile(ms,50)),1), round(float(np.percentile(ms,95)),1), round(float(ms.max()),1)
+        latencies = [t for kind in latencyKinds for t in timings.get(kind,[])]
+        latency = stats(latencies) if latencies else ('','','')
+        allKinds = ','.join(f"{kind}:" + '/'.join(f"{x:g}" for x in stats(seconds)) for kind, seconds in sorted(timings.items()))
+        return latency, allKinds
+
+
+class SessionProfiler:
+    """cProfile of a whole session, every thread included. A cProfile.Profile only sees the thread that enabled it, and the
+slow work happens in the prefetch and render threads, so each thread profiles itself with its own Profile (profiled())
+and dump() merges them all into one .prof file. (From Python 3.12 the main thread's profile already sees every thread,
+and enabling another one fails - profiled() then just does nothing.)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {} # -- thread name: its Profile
+        self.active = set() # -- threads whose Profile is enabled right now
+
+    def start(self):
+        '''Profiles the calling thread (the GUI's main loop) until dump()'''
+        self.enable()
+
+    @contextmanager
+    def profiled(self):
+        '''with profiler.profiled(): ... profiles the block in whatever thread it runs in'''
+        enabled = self.enable()
+        try:
+            yield
+        finally:
+            if enabled:
+                self.disable()
+
+    def enable(self):
+        import cProfile
+        name = threading.current_thread().name
+        with self.lock:
+            if name in self.active:
+                return False # -- already profiled (e.g. a case loaded by the main thread while it's being profiled)
+            profile = self.profiles.setdefault(name,cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        with self.lock:
+            self.active.add(name)
+        return True
+
+    def disable(self):
+        name = threading.current_thread().name
+        with self.lock:
+            self.profiles[name].disable()
+            self.active.discard(name)
+
+    def dump(self,path):
+        '''Stops profiling the calling thread and saves every thread's profile, merged, to path'''
+        import pstats
+        if threading.current_thread().name in self.active:
+            self.disable()
+        with self.lock:
+            profiles = [profile for profile in self.profiles.values() if profile.getstats()]
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+## ---------------------------------------------- ##
+## ----------------- GUI window ----------------- ##
+## ---------------------------------------------- ##
+## -- The review window, shared by VDP_GUI.py and the thin client (thinClient.py) so both look and save the same
+
+## -- Keys that change the threshold by one step (mouse wheel, arrow and page keys)
+thresholdKeys = {'MouseWheel:Down': -1, 'Down:40': -1, 'Next:34': -1, 'MouseWheel:Up': 1, 'Up:38': 1, 'Prior:33': 1}
+
+def buildWindow(sliceRange=4):
+    '''Builds the review window (PySimpleGUI). It's built once and reused for every case (see resetForm)'''
+    import PySimpleGUI as sg
+    sg.theme('black')
+    input_column = [
+        [sg.Button('Toggle Mask Border',key='mask_border')],
+        [sg.Text('Defect Identification Quality: '),
+         sg.Radio('Terrible','quality',key='quality1'),
+         sg.Radio('Bad','quality',key='quality2'),
+         sg.Radio('OK','quality',key='quality3'),
+         sg.Radio('Good','quality',key='quality4'),
+         sg.Radio('Excellent','quality',key='quality5')],
+        [sg.Text(f"Your VDP Estimate:"),sg.InputText(size=(5,1),key='vdp')],
+        [sg.Text(f"Guess the Disease:"),sg.Radio('Healthy','disease',key='healthy'),sg.Radio('Asthma','disease',key='asthma'),sg.Radio('CF','disease',key='CF'),sg.Radio('COPD','disease',key='COPD')],
+        [sg.Text(f"Disease Severity:   "),sg.Radio('None','severity',key='sev0'),sg.Radio('Mild','severity',key='sev1'),sg.Radio('Moderate','severity',key='sev2'),sg.Radio('Severe','severity',key='sev3')]]
+    artifacts_column = [[sg.Checkbox("Artifacts",default=False,key='c1',pad=(0,0))],
+        [sg.Checkbox("Coil Shading",default=False,key='c2',pad=(0,0))],
+        [sg.Checkbox("Segmentation Errors",default=False,key='c3',pad=(0,0))],
+        [sg.Checkbox("Low SNR",default=False,key='c4',pad=(0,0))],
+        [sg.Checkbox("Slices need different thresholds",default=False,enable_events=True,key='c5',pad=(0,0))],
+        [sg.Checkbox("Defects in vasculature",default=False,key='c6',pad=(0,0))],
+        [sg.Checkbox("Partial Voluming",default=False,key='c7',pad=(0,0))]]
+    layout = [
+        [sg.Image(key='-RAWIMAGE-')],
+        [sg.Image(key='-DEFECTIMAGE-')],
+        [sg.Image(key='-FILLIMAGE-',visible=False)],
+        [sg.Slider(range=(sliceRange, sliceRange+1), default_value=sliceRange,expand_x=True, enable_events=True,orientation='horizontal', key='-SLIDER-'),
+         sg.Text('VDP: ',size=(40,1),key='-VDPTEXT-')],
+        [sg.Column(input_column),sg.VSeperator(),sg.Column(artifacts_column)],
+        [sg.Text(f"Notes:"),sg.Input('',enable_events=True,key='notes', font=('Arial Bold', 12),size = (100,1), justification='left')],
+        [sg.Button('Save and Load Next Subject',key='-done-')]
+    ]
+    return sg.Window('Window Title', layout, return_keyboard_events=True, margins=(0, 0), finalize=True, size= (2400,700), resizable=True, element_justification='c')
+
+def resetForm(window):
+    '''Clears all of the reader's inputs so the window is ready for the next case'''
+    for key in ('quality1','healthy','sev0'):
+        window[key].reset_group()
+    for key in ('c1','c2','c3','c4','c5','c6','c7'):
+        window[key].update(False)
+    window['vdp'].update('')
+    window['notes'].update('')
+    window['-VDPTEXT-'].update('VDP: ')
+
+def readerInputs(values):
+    '''The reader's inputs from the window values, keyed by results column header'''
+    record = {}
+    if not values['vdp'] == '':
+        record['VDP Estimate'] = int(values['vdp'])
+
+    rank = -1
+    if values['quality1']: rank = 1
+    if values['quality2']: rank = 2
+    if values['quality3']: rank = 3
+    if values['quality4']: rank = 4
+    if values['quality5']: rank = 5
+    record['Quality Rank'] = rank
+
+    disease = ''
+    if values['healthy']: disease = 'healthy'
+    if values['asthma']: disease = 'asthma'
+    if values['CF']: disease = 'CF'
+    if values['COPD']: disease = 'COPD'
+    record['Disease Guess'] = f'{disease}'
+
+    severity = -1
+    if values['sev0']: severity = 0
+    if values['sev1']: severity = 1
+    if values['sev2']: severity = 2
+    if values['sev3']: severity = 3
+    record['Disease Severity'] = int(severity)
+    record['Artifacts'] = int(values['c1'])
+    record['Coil Shading'] = int(values['c2'])
+    record['Segmentation Errors'] = int(values['c3'])
+    record['Low SNR'] = int(values['c4'])
+    record['Slice Varying Threshold'] = int(values['c5'])
+    record['Vascular Defects'] = int(values['c6'])
+    record['Partial Voluming'] = int(values['c7'])
+    record['Notes v240410_RPT'] = values['notes']
+    return record
+
+def vdpText(VDP,nClusters=None,largestCluster=None):
+    '''The VDP readout under the images (clusters show '—' when they aren't known yet, see HPG.clusterStats)'''
+    if nClusters is None:
+        return f"VDP: {VDP:.1f}%   Clusters: —"
+    return f"VDP: {VDP:.1f}%   Clusters: {nClusters} (largest {largestCluster} voxels)"
+
+def stepThreshold(window,event,threshold,sliceThresholds,slider_value,sliceRange,nRows,nCol):
+    '''Applies a thresholdKeys event. Returns the new (threshold, sliceThresholds). With per-slice thresholds the
+        wheel only changes the slice under the pointer (the arrow keys, or the wheel off the images, change them all)'''
+    step = thresholdKeys[event]
+    if sliceThresholds is None:
+        return threshold+step, None
+    sliceUnder = None
+    if event.startswith('MouseWheel'):
+        sliceUnder = sliceUnderCursor(window,('-RAWIMAGE-','-DEFECTIMAGE-'),slider_value,sliceRange,nRows,nCol)
+    if sliceUnder is None:
+        return threshold+step, [t+step for t in sliceThresholds]
+    sliceThresholds = list(sliceThresholds)
+    sliceThresholds[sliceUnder] += step
+    window['-VDPTEXT-'].update(f"Slice {sliceUnder}: {sliceThresholds[sliceUnder]}")
+    return threshold, sliceThresholds
+
+
 ## ---------------------------------------------- ## 
 ## -------------- Other helpers ----------------- ##
 ## ---------------------------------------------- ## 
 
+def previewImages(path,useBias=True,sliceRange=4,downsample=2):
+    '''A quick, low resolution look at the middle slices of a 4D Nifti for while the full case is being prepared.
+        Only those slices (every 'downsample'th row and column) of the image and mask are read, in one read - the
+        dataset is the slowest axis in the file, so for a .nii.gz each separate read would decompress most of it.
+        Returns a 2D uint8 montage (see previewFromArrays)'''
+    import nibabel as nib
+    proxy = nib.load(path).dataobj
+    nSlices = proxy.shape[2]
+    first, last = max(0,nSlices//2-sliceRange), min(nSlices,nSlices//2+sliceRange)
+    if useBias:
+        block = np.asarray(proxy[::downsample,::downsample,first:last,1:3],dtype=np.float32) # -- mask, N4 images
+        mask, images = block[...,0], block[...,1]
+    else:
+        block = np.asarray(proxy[::downsample,::downsample,first:last,0:2],dtype=np.float32) # -- raw images, mask
+        images, mask = block[...,0], block[...,1]
+    return previewFromArrays(images,mask,sliceRange,downsample=1)
+
+def previewFromArrays(images,mask,sliceRange=4,downsample=2):
+    '''The same preview as previewImages from 3D arrays that are already at hand (e.g. memory mapped from the case
+        store or artifact cache): the middle slices, every 'downsample'th row and column, cropped to the mask'''
+    nSlices = images.shape[2]
+    first, last = max(0,nSlices//2-sliceRange), min(nSlices,nSlices//2+sliceRange)
+    images = np.asarray(images[::downsample,::downsample,first:last],dtype=np.float32)
+    mask = np.asarray(mask[::downsample,::downsample,first:last]) > 0
+    if mask.any():
+        rows, cols = np.flatnonzero(mask.any(axis=(1,2))), np.flatnonzero(mask.any(axis=(0,2)))
+        images = images[rows[0]:rows[-1]+1,cols[0]:cols[-1]+1]
+    scale = np.nanpercentile(images,99) if np.isfinite(images).any() else 1
+    images = np.clip(np.nan_to_num(images*(255/(scale or 1))),0,255).astype(np.uint8)
+    return images.transpose(0,2,1).reshape(images.shape[0],-1)
+
+def fileHash(path):
+    '''sha1 of a file's contents, read in chunks'''
+    sha = hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
 def get_executable_directory():
     '''Returns the path of the executable, or the python script'''
     if getattr(sys, 'frozen', False):
@@ -131,26 +1020,111 @@ def get_executable_directory():
         # Executable is not frozen
         return os.path.dirname(os.path.realpath(__file__))
 
-def load_Nifti_file(path):
-    '''Opens a Nifti Dataset'''
+def load_Nifti_file(path,dtype=np.float64):
+    '''Opens a Nifti Dataset. dtype=np.float32 halves the memory of the decoded array'''
+    import nibabel as nib
     activeNifti  = nib.load(path)
-    nii_data = activeNifti.get_fdata()
+    nii_data = activeNifti.get_fdata(dtype=dtype,caching='unchanged')
     nii_aff  = activeNifti.affine
     nii_hdr  = activeNifti.header
     return(nii_data,nii_aff,nii_hdr)
 
 def drawArray(window,A,nCol,slider_value, sliceRange, whichImage = '-BORDERIMAGE-'):
-    '''Updates the PySimpleGUI window with a new 2D array (grayscale) or 3D array (RGB 3D)'''
-    nPixels = 200
+    '''Updates the PySimpleGUI window with the slices slider_value-sliceRange to slider_value+sliceRange of a full montage'''
+    drawImage(window,A[:,nCol*(slider_value-sliceRange):nCol*(slider_value+sliceRange)],whichImage)
+
+def drawImage(window,A,whichImage):
+    '''Updates the PySimpleGUI window with a new 2D array (grayscale) or 3D array (RGB 3D), scaled to the display height'''
+    showImage(window,renderImage(A),whichImage)
+
+def renderImage(A,nPixels=200):
+    '''Turns a 2D (grayscale) or 3D (RGB) array into a PIL image scaled to nPixels high. Safe to run off the GUI thread'''
     nRows = A.shape[0]
-    imgAr = Image.fromarray(A[:,range(nCol*(slider_value-sliceRange),nCol*(slider_value+sliceRange))].astype(np.uint8))
-    imgAr = imgAr.resize((int(nPixels*2*sliceRange*nCol/nRows),nPixels))
-    image = ImageTk.PhotoImage(image=imgAr)
-    window[whichImage].update(data=image)
+    imgAr = Image.fromarray(A.astype(np.uint8,copy=False))
+    return imgAr.resize((int(nPixels*A.shape[1]/nRows),nPixels))
+
+def displayTileWidth(nRows,nCol,nPixels=200):
+    '''Width of one slice on screen when the images are nPixels high'''
+    return max(1,int(round(nPixels*nCol/nRows)))
+
+def sliceUnderCursor(window,whichImages,slider_value,sliceRange,nRows,nCol,nPixels=200):
+    '''Returns which slice the mouse pointer is over in any of the montage images (see DisplayCache), or None'''
+    tileWidth = displayTileWidth(nRows,nCol,nPixels)
+    for whichImage in whichImages:
+        widget = window[whichImage].widget
+        x = widget.winfo_pointerx() - widget.winfo_rootx()
+        y = widget.winfo_pointery() - widget.winfo_rooty()
+        if 0 <= x < widget.winfo_width() and 0 <= y < widget.winfo_height():
+            # -- the image is centered in its element
+            tile = int((x - (widget.winfo_width()-2*sliceRange*tileWidth)/2)//tileWidth)
+            if 0 <= tile < 2*sliceRange:
+                return slider_value - sliceRange + tile
+    return None
+
+def formatSliceThresholds(thresholds):
+    '''Per-slice thresholds (percent, one per slice of the cropped data) as a compact string for the xlsx, e.g. "60,60,58,..."'''
+    return ','.join(str(int(round(t))) for t in thresholds)
 
+def formatClusterSizes(sizes):
+    '''Cluster size distribution as a compact string for the xlsx: "size:count,..." where each size bin is a power of two
+        (e.g. "1:40,2:12,4:7" is 40 single voxel clusters, 12 of 2-3 voxels and 7 of 4-7 voxels)'''
+    if len(sizes) == 0:
+        return ''
+    counts = np.bincount(np.log2(sizes).astype(int))
+    return ','.join(f"{2**k}:{n}" for k, n in enumerate(counts) if n)
+
+def showImage(window,imgAr,whichImage):
+    '''Puts a PIL image on one of the window's Image elements (GUI thread only). Each element keeps its PhotoImage and
+        new images of the same size are just pasted into it, rather than making a new Tk image every time'''
+    from PIL import ImageTk
+    element = window[whichImage]
+    photo = getattr(element,'photoImage',None)
+    if photo is not None and (photo.width(),photo.height()) == imgAr.size:
+        photo.paste(imgAr)
+    else:
+        element.photoImage = ImageTk.PhotoImage(image=imgAr)
+        element.update(data=element.photoImage)
+
+def formatSweep(VDPs,thresholds=sweepThresholds,valueFormat='.1f'):
+    '''Packs a VDP sweep into a single string for the xlsx: "start:stop:step|VDP,VDP,..." (VDPs to 1 decimal).
+        Other sweeps (e.g. cluster counts, valueFormat='d') are packed the same way'''
+    step = thresholds[1]-thresholds[0]
+    header = f"{thresholds[0]:.2f}:{thresholds[-1]:.2f}:{step:.2f}"
+    return header + '|' + ','.join(f"{x:{valueFormat}}" for x in VDPs)
+
+def parseSweep(sweepString):
+    '''Inverse of formatSweep. Returns (thresholds, VDPs) as numpy arrays'''
+    header, values = sweepString.split('|')
+    start, stop, step = [float(x) for x in header.split(':')]
+    thresholds = np.round(np.arange(start,stop+step/2,step),2)
+    VDPs = np.array([float(x) for x in values.split(',')])
+    return thresholds, VDPs
+
+
+def makeCaseList(fileList,seed=None):
+    '''The reading list for one reader: [(fileName, N4view)] in random order. Each case will be reviewed 4x - twice
+        showing N4 corrected (N4view 1) and twice showing raw HPG (0). With a seed (e.g. the reader's name) the same
+        reader always gets the same order, and different readers get different orders'''
+    caseList =[]
+    caseList.extend(fileList)
+    caseList.extend(fileList)
+    caseList.extend(fileList)
+    caseList.extend(fileList)
+
+    # -- Whether or not the case is viewed w/wo N4 is given by a binary array
+    N4view = [np.zeros(len(fileList)*2),np.ones(len(fileList)*2)]
+    N4view = np.concatenate(N4view)
+
+    indices = np.arange(len(caseList))
+    if seed is None:
+        shuffle(indices)
+    else:
+        Random(seed).shuffle(indices)
+    return [(caseList[k],N4view[k]) for k in indices]
 
 def open_or_create_excel_file(parent_folder,XLname):
     '''Either opens an existing GUI results xlsx or creates one'''
+    import openpyxl
     xlsx_filePath = os.path.join(parent_folder,XLname)
     try:
         workbook = openpyxl.load_workbook(xlsx_filePath)
@@ -166,49 +1140,18 @@ def open_or_create_excel_file(parent_folder,XLname):
         workbook.save(xlsx_filePath)
         print(f"\033[94mCreated new workbook:\033[37m {xlsx_filePath}")
         worksheet = workbook[workbook.sheetnames[0]]
-        worksheet.cell(1,1,'File Name')
-        worksheet.cell(1,2,'N4 corrected view')
-        worksheet.cell(1,3,'Initial Threshold')
-        worksheet.cell(1,4,'Chosen Threshold')
-        worksheet.cell(1,5,'Calculated VDP')
-        worksheet.cell(1,6,'VDP Estimate')
-        worksheet.cell(1,7,'Quality Rank')
-        worksheet.cell(1,8,'Disease Guess')
-        worksheet.cell(1,9,'Disease Severity')
-        worksheet.cell(1,10,'Artifacts')
-        worksheet.cell(1,11,'Coil Shading')
-        worksheet.cell(1,12,'Segmentation Errors')
-        worksheet.cell(1,13,'Low SNR')
-        worksheet.cell(1,14,'Slice Varying Threshold')
-        worksheet.cell(1,15,'Vascular Defects')
-        worksheet.cell(1,16,'Partial Voluming')
-        worksheet.cell(1,17,'Time to Review')
-        worksheet.cell(1,18,'Notes v240410_RPT')
-
-
+        for col, header in enumerate(resultColumns):
+            worksheet.cell(1,col+1,header)
 
         # -- We also need to create a list of cases to be reviewed
-        # -- All data in the Nifti folder is used. Each case reviewed 3x
+        # -- All data in the Nifti folder is used. Each case reviewed 4x
         fileList = os.listdir(os.path.join(parent_folder,'Niftis\\'))
 
-        # -- Each case will be reviewed 4x - twice showing N4 corrected and twice showing raw HPG
-        caseList =[]
-        caseList.extend(fileList)
-        caseList.extend(fileList)
-        caseList.extend(fileList)
-        caseList.extend(fileList)
-
-        # -- Whether or not the case is viewed w/wo N4 is given by a binary array
-        N4view = [np.zeros(len(fileList)*2),np.ones(len(fileList)*2)]
-        N4view = np.concatenate(N4view)
-
-        indices = np.arange(len(caseList))
-        shuffle(indices)
         # -- Drop each file to be reviewed into the first column of the XL
         # -- N4 assignments go into the second column
-        for k in range(len(indices)):
-            worksheet.cell(k+2,1,caseList[indices[k]])
-            worksheet.cell(k+2,2,N4view[indices[k]])
+        for k, (fileName, N4view) in enumerate(makeCaseList(fileList)):
+            worksheet.cell(k+2,1,fileName)
+            worksheet.cell(k+2,2,N4view)
 
         workbook.save(xlsx_filePath)
 
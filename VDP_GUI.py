@@ -24,12 +24,31 @@ Latest version, 3/26/2024, RPT
 Please send feedback!
 '''
 
+import time
+script_start_time = time.perf_counter() # -- for the 'Startup:' timings printed below
 import os
+import sys
 import random
-import time
+import argparse
 import numpy as np
 import PySimpleGUI as sg
 import GUIhelperzz as gui
+import caseStore
+import artifactCache
+import resultsJournal
+
+## -- Thin client mode: with --server and --reader the cases come from a review server (reviewServer.py) instead of
+## -- the local Niftis, and results go to the server's journal (see thinClient.py)
+parser = argparse.ArgumentParser(description='VDP threshold review')
+parser.add_argument('--server',default=None,help='review with a reviewServer.py server, e.g. http://192.168.1.10:8765')
+parser.add_argument('--reader',default=None,help='your reader name on the server')
+args, _ = parser.parse_known_args()
+if args.server is not None:
+    import thinClient
+    if args.reader is None:
+        parser.error('--server needs --reader')
+    thinClient.run(args.server,args.reader)
+    sys.exit()
 
 
 ## -- This will check if the program is 'frozen' (compiled into exe by pyistaller) or just run as python code
@@ -39,129 +58,248 @@ print(f"The executable is located in: {parent_dir}")
 os.chdir(parent_dir)
 dataFolder = os.path.join(parent_dir,'Niftis\\') 
 
+## -- Timings of everything you wait for (scroll/slider to pixels, loading, saving) go to a log for this session in
+## -- XenonGuiLogs, and each case's p50/p95/max latency is saved with its results. Set the environment variable
+## -- VDP_GUI_PROFILE=1 to also cProfile the whole session (the main loop, case loading and rendering threads, merged)
+## -- into a .prof file next to the log.
+sessionName = f"session_{time.strftime('%Y%m%d_%H%M%S')}"
+logFolder = os.path.join(parent_dir,'XenonGuiLogs')
+instruments = gui.Instrumentation(os.path.join(logFolder,f"{sessionName}.log"))
+profiler = None
+if os.environ.get('VDP_GUI_PROFILE','0') not in ('','0'):
+    profiler = gui.SessionProfiler()
+    profiler.start()
+
 ## -- Results will be organized into an xlsx file
 XLname = 'XenonGuiResults.xlsx'
-
-## -- If the file already exists, we want to open it and pickup where we left off. Otherwise we will create it.
-workbook, xlsx_filePath = gui.open_or_create_excel_file(parent_dir, XLname)
-worksheet = workbook[workbook.sheetnames[0]]
-
-## -- Check the 'B' column of XL file for an empty cell. We'll start here
-startCase=1
-while worksheet['C'][startCase].value is not None:
-    startCase += 1
-
-totalCases = len(worksheet['A'])
-print(f'You are on case {startCase} out of {totalCases}')
-
-## -- Pull column A from XL as the fileList
-fileList = [worksheet['A'][k].value for k in range(len(worksheet['A']))]
-
-## -- Column B stores a 1 or 0 indicating whether raw or N4 data is to be displayed
-N4view = [worksheet['B'][k].value for k in range(len(worksheet['B']))]
-
-## -- For loop goes through each case in the worksheet starting at the first blank case
-for k in range(startCase,len(worksheet['A'])):
+xlsx_filePath = os.path.join(parent_dir, XLname)
+
+## -- Results are saved as you go into a journal (XenonGuiResults.journal.sqlite) and the xlsx is written from it
+## -- when you close the program. The first time, the journal picks up the case list and any finished cases from
+## -- the xlsx (or the xlsx is created if it doesn't exist yet), so we pickup where we left off.
+journal = resultsJournal.open_or_create_journal(parent_dir, XLname)
+caseRows = [row for row, _, _ in journal.cases()]
+
+## -- The first row without results is where we'll start
+startCase = journal.nextRow()
+if startCase is None:
+    startCase = max(caseRows,default=0)+1
+totalCases = len(caseRows)
+print(f'You are on case {startCase-1} out of {totalCases}')
+
+## -- File names (column A of the xlsx) and whether raw (0) or N4 (1) data is to be displayed (column B), by row
+fileList = {row: fileName for row, fileName, _ in journal.cases()}
+N4view = {row: view for row, _, view in journal.cases()}
+
+## -- If the Niftis have been packed into a case store (run caseStore.py) we read cases from that instead,
+## -- which is much faster. Any case missing from the store (or changed since) is loaded from its Nifti.
+useCaseStore = True
+storeFolder = os.path.join(parent_dir,'CaseStore')
+store = None
+if useCaseStore and os.path.exists(os.path.join(storeFolder,'manifest.json')):
+    store = caseStore.CaseStore(storeFolder)
+    print(f"Using the case store in {storeFolder}")
+
+## -- Preprocessed arrays for each case are cached next to the results xlsx, so reviewing a case again (or restarting)
+## -- skips all of the HPG preprocessing. The cache deletes its least recently used cases past cacheMaxBytes.
+cacheMaxBytes = 5e9
+cache = artifactCache.ArtifactCache(os.path.join(parent_dir,'XenonGuiCache'), maxBytes=cacheMaxBytes)
+
+## -- Compact mode keeps each case's images as float32 and masks as bool, which roughly halves the memory of every
+## -- loaded (and prefetched) case. Thresholds can differ from full float64 only by rounding in the 7th digit.
+compactMode = True
+
+## -- The defect filter: '2d3' (3x3 in-plane majority, the same as the original medfilt2d), '2d5' (5x5 in-plane) or
+## -- '3d3' (3x3x3, across neighboring slices too). It's saved with each case's results
+defectKernel = '2d3'
+
+def loadCase(k):
+    '''Loads and prepares the HPG for worksheet row k (this runs in the background prefetch thread). It stops between
+        stages if the program is closing (prefetcher.checkCancelled)'''
+    fromStore = store is not None and store.isCurrent(fileList[k],dataFolder)
+    if fromStore:
+        sourceHash = store.cases[fileList[k]]['sourceSha1']
+    else:
+        sourceHash = gui.fileHash(f"{dataFolder}{fileList[k]}")
+    cacheKey = artifactCache.cacheKey(sourceHash,gui.HPG.cacheVersion,defectKernel,compactMode)
+    prefetcher.checkCancelled()
+    arrays = cache.get(cacheKey)
+    if arrays is not None:
+        with instruments.timed('cached',k):
+            HPG1 = gui.HPG.fromArrays(arrays)
+    else:
+        with instruments.timed('load',k):
+            if fromStore:
+                HP, mask, N4HP = store.load(fileList[k])
+            else:
+                ## -- The data are stored in Nifti format as 4D arrays of dimension [rows, columns, slices, set]
+                ## -- The 'set' is 0 = raw ventilation images, 1 = binary mask, 2 = N4bias corrected images
+                nii_data, _, _ = gui.load_Nifti_file(f"{dataFolder}{fileList[k]}",dtype=np.float32 if compactMode else np.float64)
+                HP, mask, N4HP = nii_data[:,:,:,0], nii_data[:,:,:,1], nii_data[:,:,:,2]
+                del nii_data
+
+        prefetcher.checkCancelled()
+        ## -- The HPG class stores all analysis/display attributes (check the GUIhelperzz file for explanation)
+        with instruments.timed('preprocess',k):
+            HPG1 = gui.HPG(HP,mask,N4HP,compact=compactMode,defectKernel=defectKernel)
+        del HP, mask, N4HP # -- the HPG keeps its own cropped copies, so let go of the uncropped data right away
+        prefetcher.checkCancelled()
+        arrays = HPG1.derivedArrays()
+        prefetcher.checkCancelled()
+        cache.put(cacheKey,arrays)
+    HPG1.HPtoMontage(useBias=N4view[k])
+    return HPG1
+
+def previewCase(k):
+    '''A quick low resolution look at row k while it's being prepared. A case in the case store comes from its cached
+        arrays (or the store itself), both memory mapped and already cropped, so nothing is decoded. Otherwise only
+        the middle slices are read from the Nifti'''
+    if store is not None and store.isCurrent(fileList[k],dataFolder):
+        arrays = cache.get(artifactCache.cacheKey(store.cases[fileList[k]]['sourceSha1'],gui.HPG.cacheVersion,defectKernel,compactMode))
+        if arrays is not None:
+            HP, mask, N4HP = arrays['HP'], arrays['mask'], arrays['N4HP']
+        else:
+            HP, mask, N4HP = store.load(fileList[k])
+        return gui.previewFromArrays(N4HP if N4view[k] else HP,mask,sliceRange)
+    return gui.previewImages(f"{dataFolder}{fileList[k]}",useBias=N4view[k],sliceRange=sliceRange)
+
+## -- While you review one case, the next one(s) are loaded in the background. Each prepared case is a few
+## -- hundred MB at most, so prefetchMemoryBudget (bytes) limits how many we hold on to at once.
+prefetchDepth = 2
+prefetchMemoryBudget = 1e9
+def profiledLoadCase(k):
+    '''loadCase, profiled in the prefetch thread when the session is being profiled'''
+    with profiler.profiled():
+        return loadCase(k)
+
+prefetcher = gui.CasePrefetcher(loadCase if profiler is None else profiledLoadCase, [row for row in caseRows if row >= startCase], depth=prefetchDepth, memoryBudget=prefetchMemoryBudget)
+## -- start on the first case right away, so it's prepared while the window is built
+if startCase in fileList:
+    prefetcher.request(startCase)
+
+## -- Set VDP_GUI_STARTUP_BENCHMARK=1 to close as soon as the first case is on screen (see benchmarkGUI.py --startup)
+startupBenchmark = os.environ.get('VDP_GUI_STARTUP_BENCHMARK','0') not in ('','0')
+startupReported = False
+
+## -- Build the GUI using the PySimpleGUI module -- ##
+## -- The window is built once and reused for every case (see GUIhelperzz.buildWindow and resetForm)
+sliceRange = 4
+window = gui.buildWindow(sliceRange)
+print(f'Startup: window open after {time.perf_counter()-script_start_time:.2f} seconds')
+
+## -- The display is rendered in a background thread. Every threshold/slider/border change just asks it for a new
+## -- render, and if you scroll faster than it can keep up it skips straight to the latest one. Finished renders come
+## -- back as '-RENDERED-' events. 'shown' is what's actually on screen - that's the threshold we save.
+renderer = gui.RenderWorker(window,None,sliceRange,profiler=profiler)
+
+## -- Time from clicking save to the next case being on screen
+transition_start_time = None
+
+## -- For loop goes through each case in the worksheet starting at the first blank case (k is the xlsx row)
+for k in [row for row in caseRows if row >= startCase]:
 
     # Start a timer
     case_start_time = time.time()
-    print(f'Opening case {k}, {fileList[k]}')
-
-    ## -- The data are stored in Nifti format as 4D arrays of dimension [rows, columns, slices, set]
-    ## -- The 'set' is 0 = raw ventilation images, 1 = binary mask, 2 = N4bias corrected images
-    nii_data, _, _ = gui.load_Nifti_file(f"{dataFolder}{fileList[k]}")
-
-    ## -- The HPG class stores all analysis/display attributes (check the GUIhelperzz file for explanation)
-    HPG1 = gui.HPG(nii_data[:,:,:,0],nii_data[:,:,:,1],nii_data[:,:,:,2])
-
-    HPG1.HPtoMontage(useBias=N4view[k])
-    sliceRange = 4
-
-    ## -- Build the GUI using the PySimpleGUI module -- ##
-    sg.theme('black')
-    input_column = [
-        [sg.Button('Toggle Mask Border',key='mask_border')],
-        [sg.Text('Defect Identification Quality: '),
-         sg.Radio('Terrible','quality',key='quality1'),
-         sg.Radio('Bad','quality',key='quality2'),
-         sg.Radio('OK','quality',key='quality3'),
-         sg.Radio('Good','quality',key='quality4'),
-         sg.Radio('Excellent','quality',key='quality5')],
-        [sg.Text(f"Your VDP Estimate:"),sg.InputText(size=(5,1),key='vdp')],
-        [sg.Text(f"Guess the Disease:"),sg.Radio('Healthy','disease',key='healthy'),sg.Radio('Asthma','disease',key='asthma'),sg.Radio('CF','disease',key='CF'),sg.Radio('COPD','disease',key='COPD')],
-        [sg.Text(f"Disease Severity:   "),sg.Radio('None','severity',key='sev0'),sg.Radio('Mild','severity',key='sev1'),sg.Radio('Moderate','severity',key='sev2'),sg.Radio('Severe','severity',key='sev3')]]
-    artifacts_column = [[sg.Checkbox("Artifacts",default=False,key='c1',pad=(0,0))],
-        [sg.Checkbox("Coil Shading",default=False,key='c2',pad=(0,0))],
-        [sg.Checkbox("Segmentation Errors",default=False,key='c3',pad=(0,0))],
-        [sg.Checkbox("Low SNR",default=False,key='c4',pad=(0,0))],
-        [sg.Checkbox("Slices need different thresholds",default=False,key='c5',pad=(0,0))],
-        [sg.Checkbox("Defects in vasculature",default=False,key='c6',pad=(0,0))],
-        [sg.Checkbox("Partial Voluming",default=False,key='c7',pad=(0,0))]]
-    layout = [
-        [sg.Image(key='-RAWIMAGE-')],
-        [sg.Image(key='-DEFECTIMAGE-')],
-        [sg.Image(key='-FILLIMAGE-',visible=False)],
-        [sg.Slider(range=(sliceRange, HPG1.HP.shape[2]-sliceRange), default_value=int(HPG1.HP.shape[2]/2),expand_x=True, enable_events=True,orientation='horizontal', key='-SLIDER-')],
-        [sg.Column(input_column),sg.VSeperator(),sg.Column(artifacts_column)],
-        [sg.Text(f"Notes:"),sg.Input('',enable_events=True,key='notes', font=('Arial Bold', 12),size = (100,1), justification='left')],
-        [sg.Button('Save and Load Next Subject',key='-done-')]
-    ]
-    window = sg.Window('Window Title', layout, return_keyboard_events=True, margins=(0, 0), finalize=True, size= (2400,700), resizable=True, element_justification='c')
+    print(f'Opening case {k-1}, {fileList[k]}')
+
+    # - if the case isn't prepared yet (e.g. the first one) show a quick low resolution preview while we wait for it,
+    # - keeping the window responsive
+    event = None
+    if not prefetcher.ready(k):
+        prefetcher.request(k)
+        gui.resetForm(window)
+        window['-VDPTEXT-'].update('Preparing case...')
+        try:
+            preview = previewCase(k)
+            gui.showImage(window,gui.renderImage(preview),'-RAWIMAGE-')
+            if not startupReported:
+                print(f'Startup: preview shown after {time.perf_counter()-script_start_time:.2f} seconds')
+        except Exception:
+            pass # -- no preview is fine, the case itself still loads (or reports what's wrong with it)
+        with instruments.timed('wait',k):
+            while not prefetcher.ready(k):
+                event, values = window.read(timeout=50)
+                if event == sg.WIN_CLOSED:
+                    break
+    if event == sg.WIN_CLOSED:
+        break
+    with instruments.timed('wait',k): # -- how long you waited for the case (0 if the prefetch was done)
+        HPG1 = prefetcher.get(k)
+    print(f'Case uses {np.round(HPG1.memoryFootprint()/1e6,1)} MB of memory')
 
     # the slider is initialized to the middle slice of the dataset
     slider_value = int(HPG1.HP.shape[2]/2)
-    nCol = int(HPG1.HP.shape[1]) 
+    gui.resetForm(window)
+    window['-SLIDER-'].update(value=slider_value,range=(sliceRange, HPG1.HP.shape[2]-sliceRange))
 
     # - We need some initial threshold to calculate the defectArray. Let's randomize this between 40 and 100.
     # - This will help us avoid 'anchoring' bias in the results
     initThreshold = random.randint(40, 100)
     threshold = initThreshold
-    HPG1.calculateDefectArray(threshold/100)
-
-    ## -- These helper functions simply update the 3 display windows
     showBorder = False
-    gui.drawArray(window,HPG1.HPmontage,nCol,slider_value, sliceRange,'-RAWIMAGE-')
-    gui.drawArray(window,HPG1.defectMontage(border=showBorder),nCol,slider_value, sliceRange,'-DEFECTIMAGE-')
-    #gui.drawArray(window,HPG1.borderMontage(),nCol,slider_value, sliceRange,'-FILLIMAGE-')
+    # - ticking 'Slices need different thresholds' gives every slice its own threshold (None = one threshold for all).
+    # - The mouse wheel then changes the threshold of the slice under the pointer only.
+    sliceThresholds = None
+
+    # - anything still coming back from the last case's renders is older than this and gets ignored
+    shown = {'generation': renderer.generation, 'threshold': initThreshold}
+    renderer.setCase(HPG1)
+    renderer.submit(threshold,slider_value,showBorder,event='case')
 
 
     while True:
         event, values = window.read() # read the window values
         #print(event, values) # helpful for debugging to print any events/values
 
-        # if the GUI window is closed we break the While loop
-        # the For loop continues, but without a button press will experience a TypeError in the worksheet assignments below and kill the app
-        # (...not the cleanest approach but works!)
+        # if the GUI window is closed we break the While loop, and then the For loop below without saving this case
         if event == sg.WIN_CLOSED:
             break
+
+        # - a finished render: put it on screen, unless a newer one has already been shown
+        elif event == '-RENDERED-':
+            result = values['-RENDERED-']
+            if result['generation'] > shown['generation']:
+                if result['rawImage'] is not None:
+                    gui.showImage(window,result['rawImage'],'-RAWIMAGE-')
+                gui.showImage(window,result['defectImage'],'-DEFECTIMAGE-')
+                window['-VDPTEXT-'].update(gui.vdpText(result['VDP'],result['nClusters'],result['largestCluster']))
+                shown = result
+                instruments.record(result['event'],time.perf_counter()-result['submittedAt'],k)
+                instruments.record('render',result['renderSeconds'],k)
+                if not startupReported:
+                    startupReported = True
+                    print(f'Startup: first case on screen after {time.perf_counter()-script_start_time:.2f} seconds')
+                    if startupBenchmark:
+                        event = sg.WIN_CLOSED
+                        break
+                if transition_start_time is not None:
+                    print(f'Case-to-case transition took {np.round(time.time()-transition_start_time,3)} seconds')
+                    transition_start_time = None
         
-        # - Scroll-up events increase the threshold by 1, recalculate the defectArray, and update the windows
+        # - a render that failed: say why, the display stays on the last good render
+        elif event == '-RENDERERROR-':
+            print(f"\033[31mCouldn't update the display: {values['-RENDERERROR-']['error']!r}\033[37m")
+            print(values['-RENDERERROR-']['traceback'])
+
         elif ('mask_border') in event:
             showBorder = not showBorder
-            gui.drawArray(window,HPG1.defectMontage(border=showBorder),nCol,slider_value, sliceRange,'-DEFECTIMAGE-')
-
+            renderer.submit(threshold,slider_value,showBorder,sliceThresholds,event='border')
 
-        elif event in ('MouseWheel:Down', 'Down:40', 'Next:34'):
-            threshold-=1
-            HPG1.calculateDefectArray(threshold/100)
-            gui.drawArray(window,HPG1.defectMontage(border=showBorder),nCol,slider_value, sliceRange,'-DEFECTIMAGE-')
-            #gui.drawArray(window,HPG1.borderMontage(),nCol,slider_value, sliceRange,'-FILLIMAGE-')
-            #window['vdp'].update(f"Current VDP: {HPG1.VDP}") # can have the window update the VDP if you want
+        # - per-slice thresholds on/off: every slice starts at the current threshold
+        elif event == 'c5':
+            sliceThresholds = [threshold]*HPG1.HP.shape[2] if values['c5'] else None
+            renderer.submit(threshold,slider_value,showBorder,sliceThresholds)
 
-        # - Scroll-down events decrease the threshold by 1, recalculate the defectArray, and update the windows
-        elif event in ('MouseWheel:Up', 'Up:38', 'Prior:33'):
-            threshold+=1
-            HPG1.calculateDefectArray(threshold/100)
-            gui.drawArray(window,HPG1.defectMontage(border=showBorder),nCol,slider_value, sliceRange,'-DEFECTIMAGE-')
-            #gui.drawArray(window,HPG1.borderMontage(),nCol,slider_value, sliceRange,'-FILLIMAGE-')
-            #window['vdp'].update(f"Current VDP: {HPG1.VDP}") # can have the window update the VDP if you want
+        # - Scroll-down/up events decrease/increase the threshold by 1 and update the windows. With per-slice thresholds
+        # - the wheel only changes the slice under the pointer (the arrow keys, or the wheel off the images, change them all)
+        elif event in gui.thresholdKeys:
+            threshold, sliceThresholds = gui.stepThreshold(window,event,threshold,sliceThresholds,slider_value,sliceRange,HPG1.HP.shape[0],HPG1.HP.shape[1])
+            renderer.submit(threshold,slider_value,showBorder,sliceThresholds)
 
         # - slider events change the slice display range in the window (all 3 windows must be updated here)
         elif event in ('-SLIDER-'):
             slider_value = int(values['-SLIDER-'])
-            gui.drawArray(window,HPG1.HPmontage,nCol,slider_value, sliceRange,'-RAWIMAGE-')
-            gui.drawArray(window,HPG1.defectMontage(border=showBorder),nCol,slider_value, sliceRange,'-DEFECTIMAGE-')
-            #gui.drawArray(window,HPG1.borderMontage(),nCol,slider_value, sliceRange,'-FILLIMAGE-')
+            renderer.submit(threshold,slider_value,showBorder,sliceThresholds,event='slider')
 
         # - a button press assigns a defect quality rank and breaks the while loop
         elif ('-done-') in event:
@@ -169,49 +307,47 @@ for k in range(startCase,len(worksheet['A'])):
         else:
             pass
 
-    # - Once out of the for loop we fill the xlsx worksheet and save
+    ## -- What gets saved is the threshold that was on screen when you clicked save, so make sure the HPG's defects
+    ## -- and VDP are for that threshold (a render for a later threshold may have been in progress)
+    if event == sg.WIN_CLOSED:
+        break
+    transition_start_time = time.time()
+    save_start_time = time.perf_counter()
+    renderer.waitIdle()
+    threshold = shown['threshold']
+    if shown.get('sliceThresholds') is not None:
+        HPG1.calculateDefectArrayPerSlice(np.array(shown['sliceThresholds'])/100)
+    else:
+        HPG1.calculateDefectArray(threshold/100)
+
+    # - Once out of the while loop we save the case's results to the journal
     time_to_complete = time.time() - case_start_time
     print(f'This case took you {np.round(time_to_complete)} seconds to review. \n')
-    window.close()
-    #worksheet.cell(k+1, 9, fileList[k])
-    worksheet.cell(k+1, 3, initThreshold)
-    worksheet.cell(k+1, 4, threshold)
-    worksheet.cell(k+1, 5, HPG1.VDP)
+    record = {'Initial Threshold': initThreshold,
+              'Chosen Threshold': threshold}
     
-    if not values['vdp'] == '':
-        worksheet.cell(k+1, 6, int(values['vdp']))
-
-    rank = -1
-    if values['quality1']: rank = 1
-    if values['quality2']: rank = 2
-    if values['quality3']: rank = 3
-    if values['quality4']: rank = 4
-    if values['quality5']: rank = 5
-    worksheet.cell(k+1, 7, rank)
-
-    disease = ''
-    if values['healthy']: disease = 'healthy'
-    if values['asthma']: disease = 'asthma'
-    if values['CF']: disease = 'CF'
-    if values['COPD']: disease = 'COPD'
-    worksheet.cell(k+1, 8, f'{disease}')
-
-    severity = -1
-    if values['sev0']: severity = 0
-    if values['sev1']: severity = 1
-    if values['sev2']: severity = 2
-    if values['sev3']: severity = 3
-    worksheet.cell(k+1, 9, int(severity))
-    worksheet.cell(k+1, 10, int(values['c1']))
-    worksheet.cell(k+1, 11, int(values['c2']))
-    worksheet.cell(k+1, 12, int(values['c3']))
-    worksheet.cell(k+1, 13, int(values['c4']))
-    worksheet.cell(k+1, 14, int(values['c5']))
-    worksheet.cell(k+1, 15, int(values['c6']))
-    worksheet.cell(k+1, 16, int(values['c7']))
-    worksheet.cell(k+1, 17, time_to_complete)
-    worksheet.cell(k+1, 18, values['notes'])
-    workbook.save(os.path.join(parent_dir, XLname))
-
-# - When all cases are complete close the workbook
-workbook.close()
+    record.update(gui.readerInputs(values))
+    record['Time to Review'] = time_to_complete
+    (record['Latency p50 (ms)'], record['Latency p95 (ms)'], record['Latency max (ms)']), record['Timings'] = instruments.caseSummary(k)
+    record.update(HPG1.resultFields(shown.get('sliceThresholds')))
+    journal.append(k, record)
+    instruments.record('save',time.perf_counter()-save_start_time,k)
+    instruments.flush()
+
+# - When all cases are complete (or the window was closed) stop any background work, close the window and write the xlsx
+renderer.close()
+renderer.waitIdle()
+prefetcher.close()
+window.close()
+try:
+    journal.exportXlsx(xlsx_filePath)
+    print(f"Saved results to {xlsx_filePath}")
+except PermissionError:
+    # -- e.g. the xlsx is open in Excel. Nothing is lost, the results are all in the journal
+    print(f"\033[31mCouldn't write {xlsx_filePath} (is it open?). Run resultsJournal.py to export it later.\033[37m")
+journal.close()
+instruments.flush()
+print(f"Timings logged to {instruments.logPath}")
+if profiler is not None:
+    profiler.dump(os.path.join(logFolder,f"{sessionName}.prof"))
+    print(f"Profile saved to {os.path.join(logFolder,sessionName)}.prof (view with: python -m pstats)")
@@ -0,0 +1,93 @@
+'''
+==Derived-artifact cache==
+Every case is reviewed 4 times, and each time the HPG class redoes the same preprocessing (crop, normalize,
+threshold map, mask border, display montages). This cache keeps those derived arrays on disk so a repeat
+review (or a restart) can skip all of it. Each entry is a folder of uncompressed .npy files named after the
+sha1 of the source data plus the HPG cacheVersion, so a changed Nifti or changed preprocessing code never
+reuses old arrays. The cache is limited to maxBytes on disk - when it's full the least recently used entries
+are deleted. Each entry lists its arrays in a 'complete' file written last, so an entry that's missing any of them
+(e.g. one eviction couldn't fully delete because its files were still open) is treated as a miss.
+'''
+import os
+import json
+import shutil
+import threading
+import numpy as np
+
+
+markerName = 'complete'
+
+def cacheKey(sourceHash,cacheVersion,defectKernel='2d3',compact=False):
+    '''The key of a case's entry: its source data hash, the HPG cacheVersion and the settings the arrays depend on.
+        The GUI and the review server both use this, so they share entries'''
+    return f"{sourceHash}-v{cacheVersion}-{defectKernel}{'-compact' if compact else ''}"
+
+class ArtifactCache:
+    """Folder of cached HPG arrays (see HPG.derivedArrays), least-recently-used entries evicted past maxBytes"""
+    def __init__(self,cacheFolder,maxBytes=5e9):
+        self.cacheFolder = cacheFolder
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(cacheFolder,exist_ok=True)
+
+    def get(self,key):
+        '''Returns the dict of cached arrays for key (memory mapped, read-only) or None if there's nothing cached'''
+        entryFolder = os.path.join(self.cacheFolder,key)
+        with self.lock:
+            if not os.path.isdir(entryFolder):
+                return None
+            try:
+                with open(os.path.join(entryFolder,markerName)) as f:
+                    names = json.load(f)
+                arrays = {name: np.load(os.path.join(entryFolder,f"{name}.npy"),mmap_mode='r') for name in names}
+            except (OSError, ValueError):
+                # -- a damaged or partial entry is just a cache miss
+                shutil.rmtree(entryFolder,ignore_errors=True)
+                return None
+            os.utime(entryFolder) # -- the folder's modification time is its 'last used' time for eviction
+        return arrays
+
+    def put(self,key,arrays):
+        '''Saves a dict of arrays under key, then evicts old entries if the cache has grown past maxBytes.
+            Entries are written to a temporary folder and renamed into place so a crash can't leave half an entry'''
+        entryFolder = os.path.join(self.cacheFolder,key)
+        tempFolder = f"{entryFolder}.tmp{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tempFolder,exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tempFolder,f"{name}.npy"),np.asarray(array))
+        with open(os.path.join(tempFolder,markerName),'w') as f:
+            json.dump(sorted(arrays),f)
+        with self.lock:
+            if not os.path.isfile(os.path.join(entryFolder,markerName)):
+                # -- replace a partial entry (left by an eviction that couldn't finish), if it can be deleted now
+                shutil.rmtree(entryFolder,ignore_errors=True)
+                if not os.path.isdir(entryFolder):
+                    os.replace(tempFolder,entryFolder)
+            shutil.rmtree(tempFolder,ignore_errors=True)
+            self.evict()
+
+    def entries(self):
+        '''Returns [(last used time, size in bytes, folder)] for every cache entry, oldest first'''
+        entries = []
+        for name in os.listdir(self.cacheFolder):
+            entryFolder = os.path.join(self.cacheFolder,name)
+            if '.tmp' in name or not os.path.isdir(entryFolder):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entryFolder))
+            entries.append((os.path.getmtime(entryFolder),size,entryFolder))
+        return sorted(entries)
+
+    def evict(self):
+        '''Deletes least recently used entries until the cache fits in maxBytes'''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entryFolder in entries:
+            if total <= self.maxBytes:
+                break
+            # -- the marker goes first, so if the rest can't be deleted (files still open on Windows) it's a miss anyway
+            try:
+                os.remove(os.path.join(entryFolder,markerName))
+            except OSError:
+                pass
+            shutil.rmtree(entryFolder,ignore_errors=True)
+            total -= size
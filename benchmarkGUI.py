@@ -0,0 +1,259 @@
+'''
+==GUI benchmark==
+Times every step the GUI does on synthetic lung phantoms (syntheticPhantoms.py) at several matrix sizes and slice
+counts, so we can see whether the GUI keeps up as datasets grow and catch slowdowns between versions:
+    load       gui.load_Nifti_file of a compressed 4D Nifti [rows, cols, slices, 3]
+    init       HPG.__init__ (crop, normalize, threshold map, mask border, montages, cluster sweep)
+    defects    HPG.calculateDefectArray            -+ one threshold change (scroll event) = these two
+    tiles      DisplayCache.defectImage after a threshold change (the displayed slices redrawn and scaled) -+
+    slider     one slider step with the display tiles already made (raw and defect images)
+    compose    HPG.composeView (the displayed slices, whole montage) -+ what a scroll event cost before the
+    encode     renderImage (the image scaling done by drawArray)     -+ display cache, for comparison
+    photo      ImageTk.PhotoImage of that image (only if there's a display)
+    montage    HPG.defectMontage (all slices)
+    sweep      HPG.thresholdSweep
+    append     saving one case to the results journal
+    xlsx       exporting the journal to the xlsx (the workbook save) with nCases reviewed cases
+Results are printed and written as JSON (--output). The per-event latency (defects+tiles) is checked
+against a budget (--budget, ms) and with --compare a previous JSON is checked for regressions; the exit code is
+1 if either fails, so it can run as a check between versions.
+With --startup it instead measures how quickly the GUI starts in script mode (each in a fresh python process):
+the import time of the GUI modules (and of the heavy modules they now import lazily), the low resolution preview
+against preparing the whole first case, and - if PySimpleGUI and a display are available - running VDP_GUI.py on
+phantoms until the window is open and until the first case is on screen.
+Examples:
+    python benchmarkGUI.py
+    python benchmarkGUI.py --startup
+    python benchmarkGUI.py --sizes 128x128x20 256x256x40 --output bench_new.json --compare bench_old.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+import GUIhelperzz as gui
+import resultsJournal
+import syntheticPhantoms
+
+defaultSizes = [(128,128,16),(128,128,32),(256,256,32),(256,256,64)]
+eventStages = ('defects','tiles')
+
+
+def timeStage(function,repeats):
+    '''Runs function repeats times and returns each run's time in seconds'''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    return times
+
+def summarize(times):
+    times = 1000*np.array(times)
+    return {'n': len(times), 'median_ms': float(np.median(times)), 'p95_ms': float(np.percentile(times,95)), 'max_ms': float(times.max())}
+
+def photoImageMaker():
+    '''ImageTk.PhotoImage needs a Tk root (and so a display). Returns a function making PhotoImages, or None without a display'''
+    try:
+        import tkinter
+        from PIL import ImageTk
+        root = tkinter.Tk()
+        root.withdraw()
+    except Exception:
+        return None
+    return lambda image: ImageTk.PhotoImage(image=image)
+
+def benchmarkSize(shape,folder,repeats=20,nCases=500,sliceRange=4,makePhoto=None,defectKernel='2d3'):
+    '''Times every stage for one phantom size. Returns {stage: summary}'''
+    rows, cols, slices = shape
+    path = os.path.join(folder,f"phantom_{rows}x{cols}x{slices}.nii.gz")
+    nib.save(nib.Nifti1Image(syntheticPhantoms.makePhantomNifti(rows=rows,cols=cols,slices=slices,seed=0),affine=np.eye(4)),path)
+    results = {}
+    loaded = {}
+    def load():
+        loaded['data'] = gui.load_Nifti_file(path,dtype=np.float32)[0]
+    results['load'] = timeStage(load,max(1,repeats//5))
+    nii_data = loaded.pop('data')
+    HPGs = []
+    results['init'] = timeStage(lambda: HPGs.append(gui.HPG(nii_data[:,:,:,0],nii_data[:,:,:,1],nii_data[:,:,:,2],compact=True,defectKernel=defectKernel)),max(1,repeats//5))
+    HPG1 = HPGs[-1]
+    del HPGs[:-1]
+
+    # -- one scroll event: a new threshold, the displayed slices composed and scaled
+    sliceRange = min(sliceRange,HPG1.HP.shape[2]//2)
+    middle = HPG1.HP.shape[2]//2
+    first, last = middle-sliceRange, middle+sliceRange
+    thresholds = iter(np.linspace(0.4,1.0,repeats))
+    results['defects'] = timeStage(lambda: HPG1.calculateDefectArray(next(thresholds)),repeats)
+    display = gui.DisplayCache(HPG1)
+    def tiles():
+        display.invalidate()
+        display.defectImage(first,last)
+    results['tiles'] = timeStage(tiles,repeats)
+    display.defectImage(0,HPG1.HP.shape[2])
+    sliderPositions = iter(np.arange(repeats) % max(1,HPG1.HP.shape[2]-2*sliceRange+1))
+    def slider():
+        position = next(sliderPositions)
+        display.rawImage(position,position+2*sliceRange)
+        display.defectImage(position,position+2*sliceRange)
+    results['slider'] = timeStage(slider,repeats)
+    results['compose'] = timeStage(lambda: HPG1.composeView(first,last),repeats)
+    view = HPG1.composeView(first,last)
+    results['encode'] = timeStage(lambda: gui.renderImage(view),repeats)
+    if makePhoto is not None:
+        image = gui.renderImage(view)
+        results['photo'] = timeStage(lambda: makePhoto(image),repeats)
+    results['montage'] = timeStage(HPG1.defectMontage,max(1,repeats//5))
+    results['sweep'] = timeStage(HPG1.thresholdSweep,max(1,repeats//5))
+
+    # -- saving: one journal record per case, and the xlsx written from nCases of them
+    journal = resultsJournal.ResultsJournal(os.path.join(folder,f"bench_{rows}x{cols}x{slices}.journal.sqlite"))
+    journal.addCases([(k+2,f"case{k}.nii",float(k%2)) for k in range(nCases)])
+    record = {'Initial Threshold': 60,'Chosen Threshold': 60,'Calculated VDP': HPG1.VDP,'Quality Rank': 3,
+              'VDP Sweep': gui.formatSweep(HPG1.thresholdSweep())}
+    caseRows = iter(range(2,nCases+2))
+    results['append'] = timeStage(lambda: journal.append(next(caseRows),record),min(repeats,nCases))
+    for row in caseRows:
+        journal.append(row,record)
+    results['xlsx'] = timeStage(lambda: journal.exportXlsx(os.path.join(folder,'bench.xlsx')),max(1,repeats//10))
+    journal.close()
+
+    summary = {stage: summarize(times) for stage, times in results.items()}
+    summary['event'] = {'median_ms': sum(summary[stage]['median_ms'] for stage in eventStages),
+                        'p95_ms': sum(summary[stage]['p95_ms'] for stage in eventStages)}
+    return summary
+
+def runBenchmark(sizes=defaultSizes,repeats=20,nCases=500,defectKernel='2d3'):
+    '''Benchmarks every size and returns the results as a JSON-ready dict'''
+    makePhoto = photoImageMaker()
+    results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.platform(), 'cpus': os.cpu_count(), 'repeats': repeats, 'nCases': nCases,
+               'defectKernel': defectKernel, 'sizes': {}}
+    with tempfile.TemporaryDirectory() as folder:
+        for shape in sizes:
+            name = 'x'.join(str(n) for n in shape)
+            print(f"Benchmarking {name} ...")
+            results['sizes'][name] = benchmarkSize(shape,folder,repeats,nCases,makePhoto=makePhoto,defectKernel=defectKernel)
+    return results
+
+def timeInFreshPython(code,repeats=3):
+    '''Runs code (which must print one number of seconds) in a new python process repeats times. Returns the times'''
+    here = os.path.dirname(os.path.realpath(__file__))
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable,'-c',code],cwd=here,capture_output=True,text=True,check=True).stdout
+        times.append(float(output.split()[-1]))
+    return times
+
+def benchmarkStartup(repeats=3,shape=(128,128,20),scriptTimeout=300):
+    '''Startup timings in script mode (see the file header). Returns a JSON-ready dict'''
+    here = os.path.dirname(os.path.realpath(__file__))
+    results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'machine': platform.platform(), 'startup': {}}
+    timer = "import time; start=time.perf_counter(); {}; print(time.perf_counter()-start)"
+    stages = {'import GUI modules': timer.format("import GUIhelperzz, resultsJournal, caseStore, artifactCache"),
+              'import heavy modules': timer.format("import nibabel, scipy.ndimage, scipy.sparse.csgraph, openpyxl")}
+    with tempfile.TemporaryDirectory() as folder:
+        dataFolder = os.path.join(folder,'Niftis')
+        fileNames = syntheticPhantoms.writePhantomFolder(dataFolder,2,rows=shape[0],cols=shape[1],slices=shape[2])
+        path = os.path.join(dataFolder,fileNames[0]).replace('\\','/')
+        stages['preview first case'] = timer.format(f"import GUIhelperzz as gui; gui.previewImages('{path}')")
+        stages['prepare first case'] = timer.format(f"import numpy as np, GUIhelperzz as gui; d=gui.load_Nifti_file('{path}',dtype=np.float32)[0]; "
+                                                    "gui.HPG(d[:,:,:,0],d[:,:,:,1],d[:,:,:,2],compact=True)")
+        for name, code in stages.items():
+            results['startup'][name] = summarize(timeInFreshPython(code,repeats))
+
+        # -- the whole script, on a copy next to the phantoms (it reads 'Niftis' from its own folder)
+        for fileName in ('VDP_GUI.py','GUIhelperzz.py','caseStore.py','artifactCache.py','resultsJournal.py'):
+            shutil.copy(os.path.join(here,fileName),folder)
+        environment = dict(os.environ,VDP_GUI_STARTUP_BENCHMARK='1')
+        times = {'window open': [], 'preview shown': [], 'first case on screen': []}
+        try:
+            for _ in range(repeats):
+                for name in os.listdir(folder):
+                    # -- start every run from scratch (no journal, cache or logs)
+                    if name.startswith('XenonGui') and os.path.isdir(os.path.join(folder,name)):
+                        shutil.rmtree(os.path.join(folder,name))
+                    elif name.startswith('XenonGui'):
+                        os.remove(os.path.join(folder,name))
+                output = subprocess.run([sys.executable,'VDP_GUI.py'],cwd=folder,env=environment,capture_output=True,text=True,timeout=scriptTimeout).stdout
+                for line in output.splitlines():
+                    for name in times:
+                        if line.startswith(f'Startup: {name} after'):
+                            times[name].append(float(line.split()[-2]))
+            for name, values in times.items():
+                if values:
+                    results['startup'][f'script: {name}'] = summarize(values)
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"Couldn't run VDP_GUI.py ({e}), skipping the script timings")
+        if not times['first case on screen']:
+            print('VDP_GUI.py needs PySimpleGUI and a display for the script timings, skipped')
+    return results
+
+def printResults(results):
+    stages = ['load','init','defects','tiles','slider','compose','encode','photo','montage','sweep','append','xlsx','event']
+    print('\nmedian ms    ' + ''.join(f"{stage:>9s}" for stage in stages))
+    for name, summary in results['sizes'].items():
+        print(f"{name:13s}" + ''.join(f"{summary[stage]['median_ms']:9.1f}" if stage in summary else f"{'-':>9s}" for stage in stages))
+
+def checkBudget(results,budget):
+    '''Names of sizes whose per-event p95 latency is over budget (ms)'''
+    return [name for name, summary in results['sizes'].items() if summary['event']['p95_ms'] > budget]
+
+def compareResults(results,previous,tolerance=0.2):
+    '''[(size, stage, previous ms, new ms)] for every stage more than tolerance (fraction) slower than in previous'''
+    regressions = []
+    for name, summary in results['sizes'].items():
+        for stage, stats in summary.items():
+            old = previous.get('sizes',{}).get(name,{}).get(stage)
+            # -- anything under a millisecond is mostly timer noise
+            if old is not None and stats['median_ms'] > 1 and stats['median_ms'] > (1+tolerance)*old['median_ms']:
+                regressions.append((name,stage,old['median_ms'],stats['median_ms']))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the GUI steps on synthetic phantoms')
+    parser.add_argument('--sizes',nargs='+',default=None,help='phantom sizes as ROWSxCOLSxSLICES (default: %s)' % ' '.join('x'.join(str(n) for n in s) for s in defaultSizes))
+    parser.add_argument('--repeats',type=int,default=20,help='timed repeats of each per-event step')
+    parser.add_argument('--cases',type=int,default=500,help='number of reviewed cases in the exported xlsx')
+    parser.add_argument('--budget',type=float,default=50,help='per-event (scroll) latency budget in ms, checked on the p95')
+    parser.add_argument('--output',default='benchmarkGUI.json',help='JSON results file')
+    parser.add_argument('--compare',default=None,help='previous JSON results to check for regressions')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='slowdown (fraction) counted as a regression')
+    parser.add_argument('--kernel',default='2d3',choices=sorted(gui.defectKernels),help='defect filter to benchmark')
+    parser.add_argument('--startup',action='store_true',help='measure script-mode startup instead')
+    args = parser.parse_args()
+    if args.startup:
+        results = benchmarkStartup(repeats=max(1,args.repeats//5))
+        for name, stats in results['startup'].items():
+            print(f"{name:30s} {stats['median_ms']:8.0f} ms (max {stats['max_ms']:.0f})")
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+        print(f"Results written to {args.output}")
+        sys.exit(0)
+    sizes = defaultSizes if args.sizes is None else [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+
+    results = runBenchmark(sizes,args.repeats,args.cases,args.kernel)
+    results['budget_ms'] = args.budget
+    printResults(results)
+    failed = False
+    overBudget = checkBudget(results,args.budget)
+    if overBudget:
+        failed = True
+        print(f"\033[31mPer-event latency over the {args.budget} ms budget for: {', '.join(overBudget)}\033[37m")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compareResults(results,json.load(f),args.tolerance)
+        for name, stage, old, new in regressions:
+            print(f"\033[31mRegression: {name} {stage} {old:.1f} -> {new:.1f} ms\033[37m")
+        failed = failed or bool(regressions)
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=1)
+    print(f"Results written to {args.output}")
+    sys.exit(1 if failed else 0)
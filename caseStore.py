@@ -0,0 +1,106 @@
+'''
+==Case store==
+Decoding a Nifti (and decompressing it, for .nii.gz) gives the whole 4D float64 array every time a case is
+opened, even though the GUI only ever uses the part of it inside the mask. This packs the whole 'Niftis'
+folder into one uncompressed file that can be memory mapped instead:
+ - cases.bin holds, for each case, the cropped HP and N4HP images as float32 and the cropped mask bit-packed
+ - manifest.json holds each case's shape, crop (rows/cols/slices kept from the original), where its data sit
+   in cases.bin, a checksum of each block and the size/modification time/sha1 of the source Nifti
+Opening a case from the store is then (almost) free - HP and N4HP are views straight into the memory map and
+only the mask needs unpacking. Run this script to (re)build the store in the 'CaseStore' folder next to 'Niftis'.
+The store doesn't replace the Niftis: if a case isn't in the store, or its Nifti changed since the store was
+built, VDP_GUI.py just loads the Nifti as usual.
+'''
+import os
+import json
+import time
+import zlib
+import numpy as np
+import GUIhelperzz as gui
+
+storeVersion = 1
+alignment = 64 # -- each block starts on a 64 byte boundary
+
+
+def packNiftiFolder(niftiFolder,storeFolder):
+    '''Packs every Nifti in niftiFolder into storeFolder (cases.bin + manifest.json). The new store is written
+        to temporary files and swapped in at the end, so a half-finished conversion never replaces a good store.'''
+    os.makedirs(storeFolder,exist_ok=True)
+    binPath = os.path.join(storeFolder,'cases.bin')
+    manifestPath = os.path.join(storeFolder,'manifest.json')
+    manifest = {'version': storeVersion, 'cases': {}}
+    fileList = sorted(os.listdir(niftiFolder))
+    with open(binPath+'.tmp','wb') as f:
+        for k, fileName in enumerate(fileList):
+            start_time = time.time()
+            sourcePath = os.path.join(niftiFolder,fileName)
+            nii_data, _, _ = gui.load_Nifti_file(sourcePath)
+            rows,cols,slices = gui.HPG.cropToData(nii_data[:,:,:,1])
+            crop = np.ix_(rows,cols,slices)
+            blocks = {'HP': nii_data[:,:,:,0][crop].astype(np.float32),
+                      'N4HP': nii_data[:,:,:,2][crop].astype(np.float32),
+                      'mask': np.packbits(nii_data[:,:,:,1][crop]>0,axis=None)}
+            entry = {'shape': [len(rows),len(cols),len(slices)],
+                     'rows': rows, 'cols': cols, 'slices': slices,
+                     'sourceSize': os.path.getsize(sourcePath),
+                     'sourceMtime': os.path.getmtime(sourcePath),
+                     'sourceSha1': gui.fileHash(sourcePath),
+                     'blocks': {}}
+            for name, block in blocks.items():
+                f.write(b'\0'*(-f.tell() % alignment))
+                data = np.ascontiguousarray(block).tobytes()
+                entry['blocks'][name] = {'offset': f.tell(), 'nbytes': len(data), 'dtype': block.dtype.str, 'crc32': zlib.crc32(data)}
+                f.write(data)
+            manifest['cases'][fileName] = entry
+            print(f'Packed case {k+1}/{len(fileList)}: {fileName} in {np.round(time.time()-start_time,2)} seconds')
+        f.flush()
+        os.fsync(f.fileno())
+    with open(manifestPath+'.tmp','w') as f:
+        json.dump(manifest,f)
+    os.replace(binPath+'.tmp',binPath)
+    os.replace(manifestPath+'.tmp',manifestPath)
+    return manifestPath
+
+
+class CaseStore:
+    """A packed case store (see packNiftiFolder) opened as a read-only memory map. load() returns the same
+(HP, mask, N4HP) arrays you'd give the HPG class, already cropped to the mask."""
+    def __init__(self,storeFolder):
+        with open(os.path.join(storeFolder,'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != storeVersion:
+            raise ValueError(f"Case store version {manifest['version']} isn't supported (expected {storeVersion}), please rebuild it")
+        self.cases = manifest['cases']
+        self.data = np.memmap(os.path.join(storeFolder,'cases.bin'),dtype=np.uint8,mode='r')
+
+    def isCurrent(self,fileName,niftiFolder):
+        '''True if the case is in the store and its source Nifti hasn't changed (size and modification time) since packing'''
+        entry = self.cases.get(fileName)
+        if entry is None:
+            return False
+        sourcePath = os.path.join(niftiFolder,fileName)
+        if not os.path.exists(sourcePath):
+            return True # -- the store can be used without the Niftis
+        return entry['sourceSize'] == os.path.getsize(sourcePath) and entry['sourceMtime'] == os.path.getmtime(sourcePath)
+
+    def block(self,fileName,name,verify=False):
+        '''Returns one packed block of a case as a flat (read-only) array viewing the memory map'''
+        info = self.cases[fileName]['blocks'][name]
+        raw = self.data[info['offset']:info['offset']+info['nbytes']]
+        if verify and zlib.crc32(raw) != info['crc32']:
+            raise ValueError(f'Checksum mismatch in the case store for {fileName} ({name})')
+        return raw.view(np.dtype(info['dtype']))
+
+    def load(self,fileName,verify=False):
+        '''Returns (HP, mask, N4HP) for a case. HP and N4HP are float32 views into the store, mask is uint8.
+            verify=True checks the block checksums first (reads the whole case)'''
+        shape = tuple(self.cases[fileName]['shape'])
+        HP = self.block(fileName,'HP',verify).reshape(shape)
+        N4HP = self.block(fileName,'N4HP',verify).reshape(shape)
+        mask = np.unpackbits(self.block(fileName,'mask',verify),count=int(np.prod(shape))).reshape(shape)
+        return HP, mask, N4HP
+
+
+if __name__ == "__main__":
+    parent_dir = gui.get_executable_directory()
+    packNiftiFolder(os.path.join(parent_dir,'Niftis'),os.path.join(parent_dir,'CaseStore'))
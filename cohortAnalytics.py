@@ -0,0 +1,327 @@
+'''
+==Cohort analytics==
+Answers the study questions from all of the readers' results at once: intra-observer reproducibility (each reader's
+two reads of the same case and view), inter-observer agreement, the effect of N4 correction on the chosen threshold,
+and agreement with the literature thresholds from analysisBuilder.py (VDP_GUI_thresholds.xlsx).
+Inputs are any mix of reader workbooks (XenonGuiResults*.xlsx) and results journals (*.journal.sqlite, every reader
+in them). The reader of a workbook (or of the GUI's own reads in a journal) is the part of the file name after
+'XenonGuiResults_', or the name of its folder for a plain XenonGuiResults.xlsx (each reader's own copy of the GUI),
+or is given as path=reader with --reader. Reads are joined on file name and 'N4 corrected view'.
+For each comparison we report the ICC(2,1) (two-way random, absolute agreement), Bland-Altman bias and limits of
+agreement, and percentile bootstrap confidence intervals. The bootstrap resamples cases, all resamples of a chunk
+at once as one array calculation, with the chunks spread over a process pool.
+Everything is cached in XenonGuiCohortCache: files are only re-read when they change, and each comparison is keyed by
+a hash of its data, so adding one reader only recomputes the comparisons that reader is part of.
+Results go to VDP_GUI_cohort.xlsx.
+Examples:
+    python cohortAnalytics.py
+    python cohortAnalytics.py results/*.xlsx results/*.journal.sqlite --boot 5000 --workers 4
+    python cohortAnalytics.py a/XenonGuiResults.xlsx b/XenonGuiResults.xlsx --reader a/XenonGuiResults.xlsx=RPT
+'''
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import openpyxl
+import GUIhelperzz as gui
+import resultsJournal
+
+cohortVersion = 1 # -- bump when a calculation below changes, so cached results aren't reused
+bootChunk = 250 # -- bootstrap resamples per task (fixed, so results don't depend on the number of workers)
+
+
+## ---------------------------------------------- ##
+## ------------------ Reading ------------------- ##
+## ---------------------------------------------- ##
+
+def defaultReader(path):
+    '''The reader of a results file: the part of the name after 'XenonGuiResults_', the folder name for a plain
+        XenonGuiResults.xlsx/.journal.sqlite (every reader's GUI writes the same name), otherwise the file name'''
+    name = os.path.basename(path).split('.journal.sqlite')[0]
+    name = os.path.splitext(name)[0] if name.endswith('.xlsx') else name
+    if name.startswith('XenonGuiResults_'):
+        return name.split('XenonGuiResults_',1)[-1]
+    if name == 'XenonGuiResults':
+        return os.path.basename(os.path.dirname(os.path.abspath(path))) or name
+    return name
+
+def exportSource(path):
+    '''The journal a results file was (or would have been) exported from: XenonGuiResults_<reader>.xlsx and
+        XenonGuiResults.xlsx both come from XenonGuiResults.journal.sqlite in the same folder'''
+    name = os.path.basename(path).split('.journal.sqlite')[0]
+    name = os.path.splitext(name)[0] if name.endswith('.xlsx') else name
+    if name.startswith('XenonGuiResults_'):
+        name = 'XenonGuiResults'
+    return os.path.join(os.path.dirname(os.path.abspath(path)),name+'.journal.sqlite')
+
+def readsFromWorkbook(path,reader=None):
+    '''Every reviewed case in a results xlsx as a list of dicts (fileName, N4view, row, threshold, VDP).
+        The reader defaults to defaultReader(path)'''
+    workbook = openpyxl.load_workbook(path,read_only=True)
+    worksheet = workbook[workbook.sheetnames[0]]
+    rows = worksheet.iter_rows(values_only=True)
+    headers = list(next(rows))
+    reader = reader or defaultReader(path)
+    reads = []
+    for k, values in enumerate(rows):
+        record = dict(zip(headers,values))
+        if record.get('File Name') is not None and record.get('Chosen Threshold') is not None:
+            reads.append(makeRead(reader,k+2,record['File Name'],record.get('N4 corrected view'),record))
+    workbook.close()
+    return reads
+
+def readsFromJournal(path,reader=None):
+    '''Every reviewed case of every reader in a results journal, like readsFromWorkbook. reader names the GUI's own
+        (unnamed) reader, it defaults to defaultReader(path)'''
+    name = reader or defaultReader(path)
+    reads = []
+    for reader in resultsJournal.journalReaders(path):
+        journal = resultsJournal.ResultsJournal(path,reader=reader)
+        results = journal.latestResults()
+        for row, fileName, N4view in journal.cases():
+            if row in results and results[row].get('Chosen Threshold') is not None:
+                reads.append(makeRead(reader or name,row,fileName,N4view,results[row]))
+        journal.close()
+    return reads
+
+def makeRead(reader,row,fileName,N4view,record):
+    return {'reader': reader, 'row': row, 'fileName': fileName, 'N4view': int(float(N4view or 0)),
+            'threshold': float(record['Chosen Threshold']),
+            'VDP': None if record.get('Calculated VDP') is None else float(record['Calculated VDP'])}
+
+def readReferenceThresholds(path):
+    '''{fileName: {'MA': threshold, 'LB': ..., 'KM': ...}} in percent (like 'Chosen Threshold'), from analysisBuilder.py'''
+    workbook = openpyxl.load_workbook(path,read_only=True)
+    rows = workbook[workbook.sheetnames[0]].iter_rows(values_only=True)
+    headers = list(next(rows))
+    references = {}
+    for values in rows:
+        record = dict(zip(headers,values))
+        references[record['File']] = {name: 100*record[f'{name} threshold'] for name in ('MA','LB','KM')}
+    workbook.close()
+    return references
+
+class CohortCache:
+    """Parsed input files (re-read only when their size or modification time changes) and comparison results
+(keyed by a hash of their data and settings), in a folder of JSON files"""
+    def __init__(self,cacheFolder):
+        self.cacheFolder = cacheFolder
+        os.makedirs(os.path.join(cacheFolder,'reads'),exist_ok=True)
+        self.resultsPath = os.path.join(cacheFolder,'results.json')
+        self.results = {}
+        if os.path.exists(self.resultsPath):
+            with open(self.resultsPath) as f:
+                self.results = json.load(f)
+        self.hits, self.misses = 0, 0
+
+    def reads(self,path,reader=None):
+        stat = os.stat(path)
+        cachePath = os.path.join(self.cacheFolder,'reads',hashlib.sha1(f"{os.path.abspath(path)}|{reader}".encode()).hexdigest()+'.json')
+        if os.path.exists(cachePath):
+            with open(cachePath) as f:
+                cached = json.load(f)
+            if cached['stat'] == [stat.st_size,stat.st_mtime]:
+                return cached['reads']
+        reads = readsFromJournal(path,reader) if path.endswith('.sqlite') else readsFromWorkbook(path,reader)
+        writeJSON(cachePath,{'stat': [stat.st_size,stat.st_mtime], 'reads': reads})
+        return reads
+
+    def save(self):
+        writeJSON(self.resultsPath,self.results)
+
+def loadReads(inputs,cache,readerNames=None):
+    '''All reads from the input files. A read that is in both a journal and an xlsx exported from it is kept once;
+        reads from unrelated files are all kept, even when they have the same reader and row'''
+    readerNames = {os.path.abspath(path): reader for path, reader in (readerNames or {}).items()}
+    reads = {}
+    for path in inputs:
+        for read in cache.reads(path,readerNames.get(os.path.abspath(path))):
+            reads[(exportSource(path),read['reader'],read['row'])] = read
+    return list(reads.values())
+
+def writeJSON(path,content):
+    tempPath = path + '.tmp'
+    with open(tempPath,'w') as f:
+        json.dump(content,f)
+    os.replace(tempPath,path)
+
+
+## ---------------------------------------------- ##
+## ---------------- Statistics ------------------ ##
+## ---------------------------------------------- ##
+
+def iccStatistic(Y):
+    '''ICC(2,1) (Shrout & Fleiss: two-way random effects, absolute agreement, single rater) of Y [..., cases, raters],
+        for any number of leading (e.g. bootstrap) dimensions at once'''
+    n, k = Y.shape[-2], Y.shape[-1]
+    grand = Y.mean(axis=(-2,-1),keepdims=True)
+    caseMeans = Y.mean(axis=-1,keepdims=True)
+    raterMeans = Y.mean(axis=-2,keepdims=True)
+    MSR = k*np.sum((caseMeans-grand)**2,axis=(-2,-1))/(n-1)
+    MSC = n*np.sum((raterMeans-grand)**2,axis=(-2,-1))/(k-1)
+    MSE = np.sum((Y-caseMeans-raterMeans+grand)**2,axis=(-2,-1))/((n-1)*(k-1))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return (MSR-MSE)/(MSR+(k-1)*MSE+k*(MSC-MSE)/n)
+
+def blandAltmanStatistic(Y):
+    '''Bland-Altman [bias, lower limit, upper limit] of rater 0 minus rater 1 in Y [..., cases, 2]'''
+    differences = Y[...,0]-Y[...,1]
+    bias = differences.mean(axis=-1)
+    sd = differences.std(axis=-1,ddof=1)
+    return np.stack([bias,bias-1.96*sd,bias+1.96*sd],axis=-1)
+
+def allStatistics(Y):
+    '''[ICC, bias, lower limit, upper limit] for Y [..., cases, 2] (Bland-Altman is NaN for more than 2 raters)'''
+    icc = iccStatistic(Y)[...,None]
+    if Y.shape[-1] == 2:
+        return np.concatenate([icc,blandAltmanStatistic(Y)],axis=-1)
+    return np.concatenate([icc,np.full(icc.shape[:-1]+(3,),np.nan)],axis=-1)
+
+def bootstrapChunk(Y,nBoot,seedSequence):
+    '''allStatistics of nBoot resamples of Y's cases (rows), calculated together as one [nBoot, cases, raters] array'''
+    rng = np.random.default_rng(seedSequence)
+    samples = rng.integers(0,Y.shape[0],size=(nBoot,Y.shape[0]))
+    return allStatistics(Y[samples])
+
+def compare(Y,nBoot,seed,pool,alpha=0.05):
+    '''Estimates and bootstrap CIs of allStatistics for Y [cases, raters]. Returns a dict ready for the results table'''
+    estimate = allStatistics(Y)
+    seeds = np.random.SeedSequence(seed).spawn(int(np.ceil(nBoot/bootChunk)))
+    sizes = [min(bootChunk,nBoot-k*bootChunk) for k in range(len(seeds))]
+    if pool is None:
+        chunks = [bootstrapChunk(Y,size,seedSequence) for size, seedSequence in zip(sizes,seeds)]
+    else:
+        chunks = list(pool.map(bootstrapChunk,[Y]*len(seeds),sizes,seeds))
+    boot = np.concatenate(chunks)
+    low, high = np.full(4,np.nan), np.full(4,np.nan)
+    finite = np.isfinite(boot).any(axis=0) # -- (e.g. there's no Bland-Altman for more than 2 raters)
+    if finite.any():
+        low[finite], high[finite] = np.nanpercentile(boot[:,finite],[100*alpha/2,100*(1-alpha/2)],axis=0)
+    names = ['ICC','bias','LoA low','LoA high']
+    result = {'cases': int(Y.shape[0]), 'raters': int(Y.shape[1])}
+    for k, name in enumerate(names):
+        result[name] = float(estimate[k])
+        result[f'{name} CI'] = [float(low[k]),float(high[k])]
+    return result
+
+
+## ---------------------------------------------- ##
+## ---------------- Comparisons ----------------- ##
+## ---------------------------------------------- ##
+
+def comparisons(reads,references=None,measures=('threshold','VDP')):
+    '''All the comparisons to run, as [(name, Y [cases, raters])] with complete cases only:
+        intra-observer (each reader's 1st vs 2nd read of a case and view), inter-observer (each reader's mean read,
+        all readers), N4 effect (each reader's N4 vs raw mean read) and, for the threshold on N4 views, agreement with
+        each literature threshold'''
+    readers = sorted({read['reader'] for read in reads})
+    byKey = {}
+    for read in sorted(reads,key=lambda read: read['row']):
+        byKey.setdefault((read['reader'],read['fileName'],read['N4view']),[]).append(read)
+    cases = sorted({(read['fileName'],read['N4view']) for read in reads})
+    result = []
+    for measure in measures:
+        def value(reads_):
+            values = [read[measure] for read in reads_ if read[measure] is not None]
+            return np.mean(values) if values else np.nan
+        for reader in readers:
+            pairs = [[r[0][measure],r[1][measure]] for r in (byKey.get((reader,)+case,[]) for case in cases) if len(r) >= 2]
+            result.append((f'{measure} intra-observer {reader}',completeCases(pairs)))
+            for view, viewName in ((1,'N4'),(0,'raw')):
+                pairs = [[r[0][measure],r[1][measure]] for r in (byKey.get((reader,fileName,view),[]) for fileName, v in cases if v == view) if len(r) >= 2]
+                result.append((f'{measure} intra-observer {reader} {viewName}',completeCases(pairs)))
+            fileNames = sorted({fileName for fileName, _ in cases})
+            pairs = [[value(byKey.get((reader,fileName,1),[])),value(byKey.get((reader,fileName,0),[]))] for fileName in fileNames]
+            result.append((f'{measure} N4 vs raw {reader}',completeCases(pairs)))
+        if len(readers) > 1:
+            means = [[value(byKey.get((reader,)+case,[])) for reader in readers] for case in cases]
+            result.append((f'{measure} inter-observer ({len(readers)} readers)',completeCases(means)))
+            for view, viewName in ((1,'N4'),(0,'raw')):
+                means = [[value(byKey.get((reader,)+case,[])) for reader in readers] for case in cases if case[1] == view]
+                result.append((f'{measure} inter-observer {viewName}',completeCases(means)))
+    if references:
+        for name in ('MA','LB','KM'):
+            for reader in readers:
+                pairs = [[value(byKey.get((reader,fileName,1),[])),references[fileName][name]] for fileName in sorted(references)
+                         if (reader,fileName,1) in byKey]
+                result.append((f'threshold {reader} vs {name}',completeCases(pairs)))
+    return [(name,Y) for name, Y in result if Y.shape[0] >= 3]
+
+def completeCases(rows):
+    Y = np.array(rows,dtype=float).reshape(-1,len(rows[0]) if rows else 2)
+    return Y[np.all(np.isfinite(Y),axis=1)]
+
+def analyze(reads,references=None,nBoot=2000,seed=0,workers=None,cache=None):
+    '''Runs every comparison (see comparisons), reusing cached results for comparisons whose data haven't changed.
+        Returns [(name, result dict)]'''
+    tasks = comparisons(reads,references)
+    keys = [hashlib.sha1(f"{cohortVersion}|{name}|{nBoot}|{seed}|{Y.shape}".encode()+Y.tobytes()).hexdigest() for name, Y in tasks]
+    todo = [k for k, key in enumerate(keys) if cache is None or key not in cache.results]
+    pool = ProcessPoolExecutor(max_workers=workers) if todo and workers != 1 else None
+    try:
+        results = []
+        for k, ((name, Y), key) in enumerate(zip(tasks,keys)):
+            if k in todo:
+                result = compare(Y,nBoot,seed,pool)
+                if cache is not None:
+                    cache.results[key] = result
+                    cache.misses += 1
+            else:
+                result = cache.results[key]
+                cache.hits += 1
+            results.append((name,result))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if cache is not None:
+        cache.save()
+    return results
+
+def writeResults(results,xlsx_filePath):
+    workbook = openpyxl.Workbook()
+    worksheet = workbook[workbook.sheetnames[0]]
+    headers = ['Comparison','Cases','Raters','ICC','ICC CI low','ICC CI high','Bias','Bias CI low','Bias CI high',
+               'LoA low','LoA low CI low','LoA low CI high','LoA high','LoA high CI low','LoA high CI high']
+    for col, header in enumerate(headers):
+        worksheet.cell(1,col+1,header)
+    for row, (name, result) in enumerate(results):
+        values = [name,result['cases'],result['raters']]
+        for statistic in ('ICC','bias','LoA low','LoA high'):
+            values += [result[statistic]] + result[f'{statistic} CI']
+        for col, value in enumerate(values):
+            worksheet.cell(row+2,col+1,None if isinstance(value,float) and np.isnan(value) else value)
+    tempPath = xlsx_filePath + '.tmp.xlsx'
+    workbook.save(tempPath)
+    os.replace(tempPath,xlsx_filePath)
+
+
+if __name__ == "__main__":
+    parent_dir = gui.get_executable_directory()
+    parser = argparse.ArgumentParser(description='Reproducibility statistics over all readers\' results')
+    parser.add_argument('inputs',nargs='*',help='reader xlsx files and/or journals (default: XenonGuiResults*.xlsx and *.journal.sqlite here)')
+    parser.add_argument('--reader',action='append',default=[],metavar='PATH=READER',help='name the reader of an input file (repeatable)')
+    parser.add_argument('--references',default=os.path.join(parent_dir,'VDP_GUI_thresholds.xlsx'),help='literature thresholds from analysisBuilder.py')
+    parser.add_argument('--boot',type=int,default=2000,help='bootstrap resamples')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--workers',type=int,default=None,help='bootstrap processes (1 = no pool)')
+    parser.add_argument('--output',default=os.path.join(parent_dir,'VDP_GUI_cohort.xlsx'))
+    parser.add_argument('--cache',default=os.path.join(parent_dir,'XenonGuiCohortCache'))
+    args = parser.parse_args()
+    inputs = args.inputs or sorted(glob.glob(os.path.join(parent_dir,'XenonGuiResults*.xlsx'))+glob.glob(os.path.join(parent_dir,'*.journal.sqlite')))
+
+    start_time = time.time()
+    cache = CohortCache(args.cache)
+    readerNames = dict(item.rsplit('=',1) for item in args.reader)
+    reads = loadReads(inputs,cache,readerNames)
+    references = readReferenceThresholds(args.references) if os.path.exists(args.references) else None
+    print(f"{len(reads)} reads by {len({read['reader'] for read in reads})} readers from {len(inputs)} files")
+    results = analyze(reads,references,args.boot,args.seed,args.workers,cache)
+    writeResults(results,args.output)
+    for name, result in results:
+        print(f"{name:45s} n={result['cases']:4d}  ICC {result['ICC']:.3f} [{result['ICC CI'][0]:.3f}, {result['ICC CI'][1]:.3f}]"
+              f"  bias {result['bias']:+.2f}  LoA [{result['LoA low']:.2f}, {result['LoA high']:.2f}]")
+    print(f"{cache.misses} comparisons calculated, {cache.hits} from cache, in {np.round(time.time()-start_time,1)} seconds. Saved to {args.output}")
@@ -0,0 +1,137 @@
+'''
+==Results journal==
+The results of every review are appended to a small SQLite database (the journal) next to the results xlsx.
+Each save is one short, durable transaction, so saving takes the same time on case 1 and case 1000, and a
+crash (or a closed laptop lid) can at worst lose the case you were looking at - never the whole session.
+Finding where to resume is a single indexed query instead of scanning the xlsx.
+The xlsx is still the file you work with: it's exported from the journal when the GUI closes, or any time
+by running this script. The first time the journal is created it imports the case list (and any finished
+cases) from an existing xlsx, so older sessions carry on where they left off.
+'''
+import os
+import json
+import time
+import sqlite3
+import GUIhelperzz as gui
+
+
+class ResultsJournal:
+    """Append-only store of the case list and review results. Results are never overwritten - saving a case
+again just appends a newer record, and the newest record for each row is the one that counts."""
+    def __init__(self,path,reader=''):
+        self.path = path
+        self.reader = reader
+        self.connection = sqlite3.connect(path,timeout=30,check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL') # -- a saved case is on disk before append() returns
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS cases (
+                reader TEXT NOT NULL, row INTEGER NOT NULL, fileName TEXT NOT NULL, N4view REAL,
+                PRIMARY KEY (reader,row))''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, reader TEXT NOT NULL, row INTEGER NOT NULL,
+                savedAt REAL NOT NULL, record TEXT NOT NULL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS resultsByRow ON results (reader,row)')
+
+    def hasCases(self):
+        return self.connection.execute('SELECT 1 FROM cases WHERE reader=? LIMIT 1',(self.reader,)).fetchone() is not None
+
+    def addCases(self,cases):
+        '''Adds the case list: [(row, fileName, N4view)] where row is the xlsx row the case is exported to'''
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO cases (reader,row,fileName,N4view) VALUES (?,?,?,?)',
+                                        [(self.reader,row,fileName,N4view) for row, fileName, N4view in cases])
+
+    def cases(self):
+        '''Returns the case list [(row, fileName, N4view)] in row order'''
+        return self.connection.execute('SELECT row,fileName,N4view FROM cases WHERE reader=? ORDER BY row',(self.reader,)).fetchall()
+
+    def append(self,row,record):
+        '''Durably saves the results for one case. record is a dict of {column header: value}'''
+        with self.connection:
+            self.connection.execute('INSERT INTO results (reader,row,savedAt,record) VALUES (?,?,?,?)',
+                                    (self.reader,row,time.time(),json.dumps(record)))
+
+    def nextRow(self):
+        '''The first row in the case list without any results (None when everything has been reviewed)'''
+        return self.connection.execute('''SELECT MIN(row) FROM cases WHERE reader=? AND NOT EXISTS
+            (SELECT 1 FROM results WHERE results.reader=cases.reader AND results.row=cases.row)''',(self.reader,)).fetchone()[0]
+
+    def latestResults(self):
+        '''Returns {row: record} with the newest record for every reviewed row'''
+        rows = self.connection.execute('''SELECT row,record FROM results WHERE id IN
+            (SELECT MAX(id) FROM results WHERE reader=? GROUP BY row)''',(self.reader,)).fetchall()
+        return {row: json.loads(record) for row, record in rows}
+
+    def importXlsx(self,xlsx_filePath):
+        '''Fills a new journal from a results xlsx (made by open_or_create_excel_file): the case list from columns
+            A/B and, for any row with a chosen threshold, its results (matched to columns by header name)'''
+        import openpyxl # -- (imported here so it isn't loaded at startup)
+        workbook = openpyxl.load_workbook(xlsx_filePath)
+        worksheet = workbook[workbook.sheetnames[0]]
+        headers = [cell.value for cell in worksheet[1]]
+        cases, results = [], []
+        for cells in worksheet.iter_rows(min_row=2):
+            row = cells[0].row
+            if cells[0].value is None:
+                continue
+            cases.append((row,cells[0].value,cells[1].value))
+            if len(cells) > 2 and cells[2].value is not None:
+                record = {header: cell.value for header, cell in zip(headers[2:],cells[2:]) if header is not None and cell.value is not None}
+                results.append((row,record))
+        workbook.close()
+        self.addCases(cases)
+        for row, record in results:
+            self.append(row,record)
+
+    def exportXlsx(self,xlsx_filePath):
+        '''Writes the case list and newest results to an xlsx. It's written to a temporary file first and then
+            swapped in, so the old xlsx stays intact if anything goes wrong part way through'''
+        results = self.latestResults()
+        headers = list(gui.resultColumns)
+        for record in results.values():
+            headers.extend(h for h in record if h not in headers)
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        worksheet = workbook[workbook.sheetnames[0]]
+        for col, header in enumerate(headers):
+            worksheet.cell(1,col+1,header)
+        for row, fileName, N4view in self.cases():
+            worksheet.cell(row,1,fileName)
+            worksheet.cell(row,2,N4view)
+            for header, value in results.get(row,{}).items():
+                worksheet.cell(row,headers.index(header)+1,value)
+        tempPath = xlsx_filePath + '.tmp.xlsx'
+        workbook.save(tempPath)
+        os.replace(tempPath,xlsx_filePath)
+
+    def close(self):
+        self.connection.close()
+
+
+def journalReaders(path):
+    '''Names of every reader with a case list in the journal at path (the GUI's own reader is '')'''
+    connection = sqlite3.connect(path)
+    try:
+        return [reader for (reader,) in connection.execute('SELECT DISTINCT reader FROM cases ORDER BY reader')]
+    finally:
+        connection.close()
+
+
+def open_or_create_journal(parent_folder,XLname):
+    '''Opens the journal for a results xlsx, creating it from the xlsx (or a new xlsx) the first time'''
+    journal = ResultsJournal(os.path.join(parent_folder,os.path.splitext(XLname)[0]+'.journal.sqlite'))
+    if not journal.hasCases():
+        _, xlsx_filePath = gui.open_or_create_excel_file(parent_folder,XLname)
+        journal.importXlsx(xlsx_filePath)
+        print(f"\033[94mCreated results journal:\033[37m {journal.path}")
+    return journal
+
+
+if __name__ == "__main__":
+    ## -- Running this script exports the journal to the results xlsx (e.g. to look at results mid-session)
+    parent_dir = gui.get_executable_directory()
+    XLname = 'XenonGuiResults.xlsx'
+    journal = open_or_create_journal(parent_dir,XLname)
+    journal.exportXlsx(os.path.join(parent_dir,XLname))
+    print(f"Exported {len(journal.latestResults())} reviewed cases to {os.path.join(parent_dir,XLname)}")
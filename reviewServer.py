@@ -0,0 +1,359 @@
+'''
+==Multi-reader review server==
+Runs the review on one machine for several readers at once. Every case is preprocessed once (into the same
+XenonGuiCache the GUI uses, and shared in memory between readers), and each reader's display is rendered on
+the server and sent to their client as PNG images - the clients only show images and send back clicks.
+Results for every reader go into one shared results journal (XenonGuiResults.journal.sqlite, one row of the
+'cases' and 'results' tables per reader), so no two sessions ever write the same xlsx. Each reader gets their own
+reading list, shuffled the same way as open_or_create_excel_file but seeded with their name, and picks up where
+they left off.
+
+The server speaks JSON over HTTP (stdlib only):
+    GET  /next?reader=NAME                      -> the reader's next case (row, fileName, N4view, nRows/nCols/nSlices, initThreshold)
+                                                   (NAME: letters, digits, _ and - only, it goes into the export file name)
+    GET  /view?reader=NAME&threshold=60&slice=10&border=0[&sliceThresholds=60,58,...]
+                                                -> VDP, clusters and the raw/defect images (base64 PNG)
+    POST /save?reader=NAME  {"threshold":60, "record":{...reader's inputs...}}
+                                                -> saves the case (VDP, sweeps etc. are added by the server)
+    GET  /export                                -> writes XenonGuiResults_<reader>.xlsx for every reader
+Examples:
+    python reviewServer.py --port 8765
+    python reviewServer.py --simulate 4      (4 simulated readers on synthetic phantoms, prints latencies)
+Readers connect with the thin client: python thinClient.py --server http://HOST:8765 --reader NAME
+(or VDP_GUI.py with the same options).
+'''
+import os
+import io
+import json
+import re
+import time
+import base64
+import random
+import argparse
+import tempfile
+import threading
+import urllib.request
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import GUIhelperzz as gui
+import artifactCache
+import resultsJournal
+
+
+class ReviewServer(ThreadingHTTPServer):
+    """HTTP server holding the shared case data and one review session per reader"""
+    daemon_threads = True
+
+    def __init__(self,address,dataFolder,journalPath,cacheFolder,cacheMaxBytes=5e9,compact=True,sliceRange=4,workers=2,defectKernel='2d3'):
+        super().__init__(address,ReviewHandler)
+        self.dataFolder = dataFolder
+        self.journalPath = journalPath
+        self.cache = artifactCache.ArtifactCache(cacheFolder,maxBytes=cacheMaxBytes)
+        self.compact = compact
+        self.defectKernel = defectKernel
+        self.sliceRange = sliceRange
+        self.fileList = sorted(f for f in os.listdir(dataFolder) if not f.startswith('.'))
+        self.lock = threading.Lock()
+        self.prepared = {} # -- fileName: future of its derived arrays, shared by all readers (only cases someone is on or about to be on)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.sessions = {}
+
+    def caseArrays(self,fileName):
+        '''Future of the preprocessed arrays for one case. The first reader to ask starts the preprocessing (or cache read),
+            everyone else waits for the same result, so a case is only ever prepared once'''
+        with self.lock:
+            future = self.prepared.get(fileName)
+            if future is None or (future.done() and future.exception() is not None):
+                # -- a failed preparation is tried again by the next reader to ask, not remembered forever
+                future = self.prepared[fileName] = self.pool.submit(self.prepareCase,fileName)
+            return future
+
+    def releaseCases(self):
+        '''Forgets the arrays of every case no reader is on (or about to be on). Sessions keep their own HPG, so this
+            only stops the server holding a whole cohort in memory (and keeping the cache's files open, which would
+            stop them being evicted on Windows)'''
+        with self.lock:
+            inUse = set().union(*(session.fileNames for session in self.sessions.values()))
+            for fileName in [f for f in self.prepared if f not in inUse]:
+                del self.prepared[fileName]
+
+    def prepareCase(self,fileName):
+        path = os.path.join(self.dataFolder,fileName)
+        cacheKey = artifactCache.cacheKey(gui.fileHash(path),gui.HPG.cacheVersion,self.defectKernel,self.compact)
+        arrays = self.cache.get(cacheKey)
+        if arrays is None:
+            nii_data, _, _ = gui.load_Nifti_file(path,dtype=np.float32 if self.compact else np.float64)
+            HPG1 = gui.HPG(nii_data[:,:,:,0],nii_data[:,:,:,1],nii_data[:,:,:,2],compact=self.compact,defectKernel=self.defectKernel)
+            del nii_data
+            arrays = HPG1.derivedArrays()
+            self.cache.put(cacheKey,arrays)
+            # -- use the memory mapped copy so the in-memory arrays can be freed (unless it was evicted right away)
+            arrays = self.cache.get(cacheKey) or arrays
+        return arrays
+
+    def session(self,reader):
+        '''The reader's review session, created (with their reading list in the journal) the first time they connect'''
+        with self.lock:
+            if reader not in self.sessions:
+                self.sessions[reader] = ReaderSession(self,reader)
+            return self.sessions[reader]
+
+    def exportAll(self,parent_folder):
+        '''Writes every reader's results to XenonGuiResults_<reader>.xlsx in parent_folder. Returns the paths'''
+        paths = []
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            with session.lock:
+                path = os.path.join(parent_folder,f"XenonGuiResults_{session.reader}.xlsx")
+                session.journal.exportXlsx(path)
+            paths.append(path)
+        return paths
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False,cancel_futures=True)
+        for session in self.sessions.values():
+            session.journal.close()
+
+
+class ReaderSession:
+    """One reader's state: their journal, the case they're on and its HPG (the arrays are shared with the other
+readers, only the defect array and display buffer are their own)"""
+    def __init__(self,server,reader):
+        self.server = server
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.journal = resultsJournal.ResultsJournal(server.journalPath,reader=reader)
+        if not self.journal.hasCases():
+            caseList = gui.makeCaseList(server.fileList,seed=reader)
+            self.journal.addCases([(k+2,fileName,float(N4view)) for k, (fileName, N4view) in enumerate(caseList)])
+        self.cases = {row: (fileName,N4view) for row, fileName, N4view in self.journal.cases()}
+        self.row = None
+        self.HPG = None
+        self.fileNames = set() # -- the cases this reader is on and will be on next, see ReviewServer.releaseCases
+
+    def nextCase(self):
+        row = self.journal.nextRow()
+        if row is None:
+            self.row, self.HPG = None, None
+            self.fileNames = set()
+            self.server.releaseCases()
+            return {'row': None, 'remaining': 0}
+        fileName, N4view = self.cases[row]
+        later = [r for r in self.cases if r > row]
+        self.fileNames = {fileName} | ({self.cases[min(later)][0]} if later else set())
+        HPG1 = gui.HPG.fromArrays(self.server.caseArrays(fileName).result())
+        HPG1.HPtoMontage(useBias=N4view)
+        self.row, self.HPG = row, HPG1
+        self.rawImages = {} # -- encoded raw images by slider position, they don't change with threshold
+        self.initThreshold = random.randint(40,100)
+        self.startTime = time.time()
+        # -- start preparing this reader's following case while they review this one
+        if later:
+            self.server.caseArrays(self.cases[min(later)][0])
+        self.server.releaseCases()
+        remaining = sum(1 for r in self.cases if r >= row) - len([r for r in self.journal.latestResults() if r >= row])
+        return {'row': row, 'fileName': fileName, 'N4view': N4view, 'nRows': HPG1.HP.shape[0], 'nCols': HPG1.HP.shape[1], 'nSlices': HPG1.HP.shape[2],
+                'sliceRange': self.server.sliceRange, 'initThreshold': self.initThreshold, 'remaining': remaining}
+
+    def setDefects(self,threshold,sliceThresholds=None):
+        if sliceThresholds is None:
+            self.HPG.calculateDefectArray(threshold/100)
+        else:
+            self.HPG.calculateDefectArrayPerSlice(np.array(sliceThresholds)/100)
+
+    def view(self,threshold,slider_value,border,sliceThresholds=None):
+        self.setDefects(threshold,sliceThresholds)
+        nCol = self.HPG.HP.shape[1]
+        sliceRange = self.server.sliceRange
+        slider_value = min(max(slider_value,sliceRange),self.HPG.HP.shape[2]-sliceRange)
+        first, last = slider_value-sliceRange, slider_value+sliceRange
+        nClusters, largestCluster = self.HPG.clusterStats()
+        if slider_value not in self.rawImages:
+            self.rawImages[slider_value] = encodePNG(gui.renderImage(self.HPG.HPmontage[:,nCol*first:nCol*last]))
+        return {'row': self.row, 'VDP': self.HPG.VDP, 'nClusters': nClusters, 'largestCluster': largestCluster,
+                'rawImage': self.rawImages[slider_value],
+                'defectImage': encodePNG(gui.renderImage(self.HPG.composeView(first,last,border=border)))}
+
+    def save(self,threshold,record,sliceThresholds=None):
+        '''Saves the current case with the reader's inputs (record, keyed by column header like VDP_GUI.py) plus
+            everything calculated here, the same as the GUI saves it'''
+        self.setDefects(threshold,sliceThresholds)
+        record = dict(record)
+        record['Initial Threshold'] = self.initThreshold
+        record['Chosen Threshold'] = threshold
+        record['Time to Review'] = time.time()-self.startTime
+        record.update(self.HPG.resultFields(sliceThresholds))
+        self.journal.append(self.row,record)
+        return {'row': self.row, 'saved': True}
+
+
+readerPattern = re.compile(r'[A-Za-z0-9_-]+')
+
+class ReviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/export':
+                return self.reply({'exported': self.server.exportAll(os.path.dirname(self.server.journalPath))})
+            if not query.get('reader'):
+                return self.reply({'error': 'no reader given'},400)
+            if not readerPattern.fullmatch(query['reader']):
+                # -- the name goes into the exported file name, so nothing that could point outside the folder
+                return self.reply({'error': 'reader names can only have letters, digits, _ and -'},400)
+            session = self.server.session(query['reader'])
+            with session.lock:
+                if url.path == '/next':
+                    return self.reply(session.nextCase())
+                if session.HPG is None:
+                    return self.reply({'error': 'no case open, ask for /next first'},409)
+                sliceThresholds = [int(t) for t in query['sliceThresholds'].split(',')] if query.get('sliceThresholds') else None
+                if url.path == '/view':
+                    return self.reply(session.view(int(query.get('threshold',60)),int(query.get('slice',session.HPG.HP.shape[2]//2)),
+                                                   query.get('border','0') == '1',sliceThresholds))
+                if url.path == '/save' and self.command == 'POST':
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))) or b'{}')
+                    sliceThresholds = body.get('sliceThresholds',sliceThresholds)
+                    return self.reply(session.save(int(body['threshold']),body.get('record',{}),sliceThresholds))
+            self.reply({'error': f'unknown request {self.command} {url.path}'},404)
+        except Exception as e:
+            self.reply({'error': repr(e)},500)
+
+    def reply(self,content,status=200):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,format,*args):
+        pass # -- one line per scroll event is too much
+
+
+def encodePNG(image):
+    '''PIL image to base64 PNG text (for JSON)'''
+    buffer = io.BytesIO()
+    image.save(buffer,format='PNG',compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def decodePNG(text):
+    '''Inverse of encodePNG: base64 PNG text to a PIL image'''
+    from PIL import Image
+    return Image.open(io.BytesIO(base64.b64decode(text)))
+
+
+class ReviewClient:
+    """Minimal client for the review server (what a thin GUI, or a simulated reader, would use)"""
+    def __init__(self,url,reader):
+        self.url = url.rstrip('/')
+        self.reader = reader
+
+    def request(self,path,body=None,**query):
+        query['reader'] = self.reader
+        queryString = '&'.join(f"{key}={value}" for key, value in query.items())
+        data = None if body is None else json.dumps(body).encode()
+        with urllib.request.urlopen(urllib.request.Request(f"{self.url}{path}?{queryString}",data=data)) as response:
+            return json.loads(response.read())
+
+    def nextCase(self):
+        return self.request('/next')
+
+    def view(self,threshold,slider_value,border=False,sliceThresholds=None):
+        query = {'threshold': threshold, 'slice': slider_value, 'border': int(border)}
+        if sliceThresholds is not None:
+            query['sliceThresholds'] = ','.join(str(t) for t in sliceThresholds)
+        return self.request('/view',**query)
+
+    def save(self,threshold,record,sliceThresholds=None):
+        return self.request('/save',body={'threshold': threshold,'record': record,'sliceThresholds': sliceThresholds})
+
+
+def simulateReader(url,reader,nCases,nScrolls=20,seed=0):
+    '''A simulated reader: opens nCases, scrolls the threshold nScrolls times on each and saves it.
+        Returns the latency (seconds) of every request, by request type'''
+    rng = random.Random(f"{reader}-{seed}")
+    client = ReviewClient(url,reader)
+    latency = {'next': [], 'view': [], 'save': []}
+    for _ in range(nCases):
+        start = time.perf_counter()
+        case = client.nextCase()
+        latency['next'].append(time.perf_counter()-start)
+        if case['row'] is None:
+            break
+        threshold = case['initThreshold']
+        slider_value = case['nSlices']//2
+        for _ in range(nScrolls):
+            threshold += rng.choice((-1,1))
+            start = time.perf_counter()
+            client.view(threshold,slider_value)
+            latency['view'].append(time.perf_counter()-start)
+        start = time.perf_counter()
+        client.save(threshold,{'Quality Rank': rng.randint(1,5),'Notes v240410_RPT': 'simulated'})
+        latency['save'].append(time.perf_counter()-start)
+    return latency
+
+def simulate(nReaders=4,nFiles=4,nCases=3,nScrolls=20,shape=(128,128,20)):
+    '''Runs a server on synthetic phantoms in a temporary folder with nReaders simulated readers at once, checks
+        every reader's results ended up in the shared journal, and prints request latencies'''
+    import syntheticPhantoms
+    with tempfile.TemporaryDirectory() as folder:
+        dataFolder = os.path.join(folder,'Niftis')
+        syntheticPhantoms.writePhantomFolder(dataFolder,nFiles,rows=shape[0],cols=shape[1],slices=shape[2])
+        server = ReviewServer(('127.0.0.1',0),dataFolder,os.path.join(folder,'XenonGuiResults.journal.sqlite'),os.path.join(folder,'XenonGuiCache'))
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        readers = [f"reader{k+1}" for k in range(nReaders)]
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=nReaders) as pool:
+            latencies = list(pool.map(lambda reader: simulateReader(url,reader,nCases,nScrolls),readers))
+        total_time = time.time()-start_time
+        for reader in readers:
+            journal = resultsJournal.ResultsJournal(server.journalPath,reader=reader)
+            nSaved = len(journal.latestResults())
+            journal.close()
+            assert nSaved == nCases, f"{reader} saved {nSaved} of {nCases} cases"
+        assert len(server.prepared) <= 2*nReaders, f"the server is holding {len(server.prepared)} cases for {nReaders} readers"
+        exported = server.exportAll(folder)
+        server.shutdown()
+        server.server_close()
+    print(f"{nReaders} readers x {nCases} cases ({nFiles} files, shape {shape}) in {np.round(total_time,2)} seconds, {len(exported)} xlsx exported")
+    print('request   count   p50 ms   p95 ms   max ms')
+    for kind in ('next','view','save'):
+        times = 1000*np.array([t for latency in latencies for t in latency[kind]])
+        print(f"{kind:7s}  {len(times):6d}  {np.percentile(times,50):7.1f}  {np.percentile(times,95):7.1f}  {times.max():7.1f}")
+    return latencies
+
+
+if __name__ == "__main__":
+    parent_dir = gui.get_executable_directory()
+    parser = argparse.ArgumentParser(description='Review server for several readers at once')
+    parser.add_argument('--host',default='127.0.0.1',help='address to listen on (0.0.0.0 for other machines)')
+    parser.add_argument('--port',type=int,default=8765)
+    parser.add_argument('--data',default=os.path.join(parent_dir,'Niftis'),help='folder of Niftis to review')
+    parser.add_argument('--kernel',default='2d3',choices=sorted(gui.defectKernels),help='defect filter (see GUIhelperzz.defectKernels)')
+    parser.add_argument('--simulate',type=int,default=0,metavar='READERS',help='run simulated readers on phantoms instead')
+    args = parser.parse_args()
+    if args.simulate:
+        simulate(nReaders=args.simulate)
+    else:
+        server = ReviewServer((args.host,args.port),args.data,os.path.join(parent_dir,'XenonGuiResults.journal.sqlite'),
+                              os.path.join(parent_dir,'XenonGuiCache'),defectKernel=args.kernel)
+        print(f"Serving {len(server.fileList)} cases on http://{args.host}:{server.server_address[1]} (Ctrl-C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        for path in server.exportAll(parent_dir):
+            print(f"Saved results to {path}")
+        server.server_close()
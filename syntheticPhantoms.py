@@ -0,0 +1,57 @@
+'''
+==Synthetic lung phantoms==
+Makes fake HPG ventilation datasets for benchmarking (no real patient data needed). Each phantom is two
+ellipsoidal 'lungs' with uniform ventilation, a few random spherical defects, a smooth coil shading field
+and some noise - in the same 4D Nifti layout the GUI reads: [rows, columns, slices, dataset] with
+dataset 0 = HPG ventilation, 1 = binary mask and (optionally) 2 = 'N4 corrected' images. Since we know the
+shading field exactly, the 'N4 corrected' images here are just the ventilation divided by it.
+'''
+import os
+import numpy as np
+import nibabel as nib
+
+
+def makePhantom(rows=128,cols=128,slices=20,nDefects=10,shading=0.5,noise=0.05,seed=None):
+    '''Returns (HP, mask, shadingField) as float64 arrays of shape [rows, cols, slices].
+        shading is how much the coil shading field varies across the lungs (0 = none)'''
+    rng = np.random.default_rng(seed)
+    r, c, s = np.meshgrid(np.linspace(-1,1,rows),np.linspace(-1,1,cols),np.linspace(-1,1,slices),indexing='ij')
+    # -- two lungs, left and right of the middle
+    mask = np.zeros((rows,cols,slices),dtype=bool)
+    for center in (-0.45,0.45):
+        mask |= (r/0.8)**2 + ((c-center)/0.35)**2 + (s/0.9)**2 < 1
+    ventilation = np.ones((rows,cols,slices))
+    voxels = np.argwhere(mask)
+    for _ in range(nDefects):
+        center = voxels[rng.integers(len(voxels))]
+        radius = rng.uniform(0.03,0.12)*rows
+        distance = np.sqrt((np.arange(rows)[:,None,None]-center[0])**2 + (np.arange(cols)[None,:,None]-center[1])**2
+                           + ((np.arange(slices)[None,None,:]-center[2])*rows/slices)**2)
+        ventilation[distance<radius] *= rng.uniform(0,0.4)
+    # -- coil shading: a smooth gradient across the chest plus a fall off away from the coil
+    direction = rng.normal(size=3)
+    direction /= np.linalg.norm(direction)
+    shadingField = 1 + shading*(0.5*(direction[0]*r + direction[1]*c + direction[2]*s) - 0.5*(r**2+c**2))
+    shadingField = np.clip(shadingField,0.1,None)
+    HP = 100*ventilation*shadingField*mask + rng.normal(0,100*noise,size=mask.shape)
+    HP = np.abs(HP) # -- magnitude images
+    return HP, mask.astype(float), shadingField
+
+
+def makePhantomNifti(includeN4=True,**kwargs):
+    '''Returns a 4D array [rows, cols, slices, dataset] (3 datasets with includeN4, otherwise just HP and mask)'''
+    HP, mask, shadingField = makePhantom(**kwargs)
+    sets = [HP, mask, HP/shadingField] if includeN4 else [HP, mask]
+    return np.stack(sets,axis=3)
+
+
+def writePhantomFolder(folder,nCases,includeN4=True,compressed=True,seed=0,**kwargs):
+    '''Writes nCases phantom Niftis into folder and returns their file names'''
+    os.makedirs(folder,exist_ok=True)
+    fileNames = []
+    for k in range(nCases):
+        fileName = f"phantom{k:04d}.nii{'.gz' if compressed else ''}"
+        nii_data = makePhantomNifti(includeN4=includeN4,seed=seed+k,**kwargs)
+        nib.save(nib.Nifti1Image(nii_data,affine=np.eye(4)),os.path.join(folder,fileName))
+        fileNames.append(fileName)
+    return fileNames
@@ -0,0 +1,99 @@
+'''
+Checks the defect calculation against the original per-slice medfilt2d loop (and scipy's medfilt for the other defect
+filters) on small random phantoms. Run with: python -m pytest -q
+'''
+import numpy as np
+import pytest
+from scipy.signal import medfilt2d, medfilt
+import GUIhelperzz as gui
+
+thresholds = [0.2, 0.45, 0.6, 0.75, 1.0, 1.3]
+
+
+def randomCase(seed,shape=(23,19,7)):
+    '''Random HP/mask/N4HP arrays: a blobby mask that touches index 0 on every axis, NaNs outside the mask (like
+        N4 output) and a signal spread around the threshold range'''
+    rng = np.random.default_rng(seed)
+    mask = rng.random(shape) < 0.75
+    mask[0,:,:] = mask[:,0,:] = mask[:,:,0] = True
+    N4HP = rng.gamma(4,0.25,shape)
+    HP = N4HP*rng.uniform(0.5,1.5,shape)
+    N4HP[~mask & (rng.random(shape) < 0.5)] = np.nan
+    return HP, mask.astype(float), N4HP
+
+def referenceDefects(normHP,mask,thresh,kernel='2d3'):
+    '''The original calculation: median filter the thresholded image within the mask, slice by slice'''
+    binary = ((normHP<thresh)*mask).astype(float)
+    if kernel == '3d3':
+        return medfilt(binary,3) > 0
+    size = gui.defectKernels[kernel][0]
+    defectArray = np.zeros(binary.shape)
+    for k in range(binary.shape[2]):
+        defectArray[:,:,k] = medfilt2d(binary[:,:,k],size)
+    return defectArray > 0
+
+def referenceMaskBorder(mask):
+    maskBorder = np.zeros(mask.shape,dtype=bool)
+    for k in range(mask.shape[2]):
+        x = np.gradient(mask[:,:,k].astype(float))
+        maskBorder[:,:,k] = (x[0]!=0)+(x[1]!=0)
+    return maskBorder
+
+
+@pytest.mark.parametrize('compact',[False,True])
+@pytest.mark.parametrize('seed',range(4))
+def test_matches_medfilt2d(seed,compact):
+    HPG = gui.HPG(*randomCase(seed),compact=compact)
+    for thresh in thresholds:
+        HPG.calculateDefectArray(thresh)
+        reference = referenceDefects(HPG.normHP,HPG.mask,thresh)
+        assert np.array_equal(HPG.defectArray,reference), thresh
+        assert HPG.VDP == pytest.approx(np.sum(reference)/np.sum(HPG.mask>0)*100)
+
+@pytest.mark.parametrize('seed',range(2))
+def test_nan_inside_mask(seed):
+    HPG = gui.HPG(*randomCase(seed),compact=True)
+    rng = np.random.default_rng(seed)
+    HPG.normHP[(HPG.mask>0) & (rng.random(HPG.mask.shape) < 0.1)] = np.nan
+    HPG.thresholdMap = HPG.calculateThresholdMap()
+    for thresh in thresholds:
+        HPG.calculateDefectArray(thresh)
+        assert np.array_equal(HPG.defectArray,referenceDefects(HPG.normHP,HPG.mask,thresh)), thresh
+
+@pytest.mark.parametrize('kernel',['2d5','3d3'])
+@pytest.mark.parametrize('seed',range(3))
+def test_other_kernels_match_scipy(seed,kernel):
+    HPG = gui.HPG(*randomCase(seed),compact=True,defectKernel=kernel)
+    for thresh in thresholds:
+        HPG.calculateDefectArray(thresh)
+        assert np.array_equal(HPG.defectArray,referenceDefects(HPG.normHP,HPG.mask,thresh,kernel)), thresh
+
+def test_chunking_does_not_change_the_map():
+    values = np.random.default_rng(0).random((17,13,9)).astype(np.float32)
+    for kernel in gui.defectKernels:
+        assert np.array_equal(gui.criticalThresholds(values,kernel,chunkVoxels=200),gui.criticalThresholds(values,kernel))
+
+@pytest.mark.parametrize('seed',range(3))
+def test_mask_border(seed):
+    HPG = gui.HPG(*randomCase(seed))
+    assert np.array_equal(HPG.maskBorder,referenceMaskBorder(HPG.mask))
+
+@pytest.mark.parametrize('compact',[False,True])
+def test_sweep_matches_calculated_vdp(compact):
+    HP, mask, N4HP = randomCase(0)
+    HPG = gui.HPG(HP,2*mask,N4HP,compact=compact) # -- a mask that isn't 0/1 shouldn't change the VDP
+    VDPs = HPG.thresholdSweep(np.array(thresholds))
+    for thresh, VDP in zip(thresholds,VDPs):
+        HPG.calculateDefectArray(thresh)
+        assert VDP == pytest.approx(HPG.VDP)
+
+@pytest.mark.parametrize('kernel',['2d3','2d5','3d3'])
+@pytest.mark.parametrize('seed',range(2))
+def test_cluster_sweep_matches_label(seed,kernel):
+    from scipy.ndimage import label
+    HPG = gui.HPG(*randomCase(seed,shape=(40,36,9)),compact=True,defectKernel=kernel)
+    assert HPG.clusterSweep is None # -- only calculated when it's used
+    for k, thresh in enumerate(HPG.clusterThresholds):
+        labels, nClusters = label(HPG.thresholdMap < thresh)
+        assert HPG.clusterCounts[k] == nClusters, thresh
+        assert HPG.largestClusters[k] == (np.bincount(labels.ravel())[1:].max() if nClusters else 0), thresh
@@ -0,0 +1,84 @@
+'''
+==Thin client==
+The review window for a reader connected to reviewServer.py. The server does all of the work (loading, defects,
+rendering, saving to the shared journal) - this only shows the images it sends back and sends it the reader's
+threshold, slider, border and form inputs. The window and controls are the same as VDP_GUI.py (GUIhelperzz.buildWindow).
+Threshold and slider changes that come in faster than the server answers are merged into one request, so the
+display always catches up to the latest state instead of replaying every wheel click.
+Examples:
+    python thinClient.py --server http://192.168.1.10:8765 --reader RPT
+    python VDP_GUI.py --server http://192.168.1.10:8765 --reader RPT
+'''
+import time
+import argparse
+import urllib.error
+import PySimpleGUI as sg
+import GUIhelperzz as gui
+from reviewServer import ReviewClient, decodePNG
+
+
+def run(url,reader):
+    '''Reviews cases from the server at url as reader until they're all done or the window is closed'''
+    client = ReviewClient(url,reader)
+    window = gui.buildWindow()
+    closed = False
+    while not closed:
+        case = client.nextCase()
+        if case['row'] is None:
+            print('All your cases are done!')
+            break
+        print(f"Opening case {case['row']-1}, {case['fileName']} ({case['remaining']} left)")
+        sliceRange, nSlices = case['sliceRange'], case['nSlices']
+        slider_value = nSlices//2
+        gui.resetForm(window)
+        window['-SLIDER-'].update(value=slider_value,range=(sliceRange,nSlices-sliceRange))
+        threshold = case['initThreshold']
+        showBorder = False
+        sliceThresholds = None
+        shownSlider = None # -- the raw image only changes with the slider
+        stale = True # -- the display doesn't match the current state yet
+
+        while True:
+            # -- wait for the next event, or once the burst of events is over, bring the display up to date
+            event, values = window.read(timeout=10 if stale else None)
+            if event == sg.WIN_CLOSED:
+                closed = True
+                break
+            elif event == sg.TIMEOUT_EVENT:
+                try:
+                    view = client.view(threshold,slider_value,showBorder,sliceThresholds)
+                except urllib.error.URLError as e:
+                    print(f"\033[31mCouldn't update the display: {e}\033[37m")
+                    time.sleep(1)
+                    continue
+                if slider_value != shownSlider:
+                    gui.showImage(window,decodePNG(view['rawImage']),'-RAWIMAGE-')
+                    shownSlider = slider_value
+                gui.showImage(window,decodePNG(view['defectImage']),'-DEFECTIMAGE-')
+                window['-VDPTEXT-'].update(gui.vdpText(view['VDP'],view['nClusters'],view['largestCluster']))
+                stale = False
+            elif 'mask_border' in event:
+                showBorder = not showBorder
+                stale = True
+            elif event == 'c5':
+                sliceThresholds = [threshold]*nSlices if values['c5'] else None
+                stale = True
+            elif event in gui.thresholdKeys:
+                threshold, sliceThresholds = gui.stepThreshold(window,event,threshold,sliceThresholds,slider_value,sliceRange,case['nRows'],case['nCols'])
+                stale = True
+            elif event == '-SLIDER-':
+                slider_value = int(values['-SLIDER-'])
+                stale = True
+            elif '-done-' in event:
+                # -- the server works out the VDP, sweeps and clusters for this threshold itself
+                client.save(threshold,gui.readerInputs(values),sliceThresholds)
+                break
+    window.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Review cases served by reviewServer.py')
+    parser.add_argument('--server',required=True,help='the review server, e.g. http://192.168.1.10:8765')
+    parser.add_argument('--reader',required=True,help='your reader name (letters, digits, _ and -)')
+    args = parser.parse_args()
+    run(args.server,args.reader)